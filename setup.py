@@ -37,5 +37,6 @@ setup(
     scripts=['sourcemap_tool.py'],
     extras_require={
         'lexer': ['Pygments'],
+        'numpy': ['numpy'],
     }
 )
@@ -0,0 +1,200 @@
+import argparse
+import io
+import json
+import platform
+import random
+import time
+import tracemalloc
+from os import makedirs
+from os.path import join
+from sys import stderr
+
+import sourcemap_lib
+from sourcemap_lib import SourceMap, SegmentArrays, ConcatWriter, parse_vlq64, decode_mappings, encode_mappings, \
+    create_from_json, create_from_file, create_from_binary, cascade_chain, concat_sourcemaps
+
+
+def generate_map(lines=2000, segments=40, sources=20, names=200, seed=0, sourcelines=1000, sourcecolumns=120, file='out.js'):
+    '''
+    Deterministic sourcemap resembling bundler output: runs of segments from the same source,
+    original lines mostly going forward, names on some identifiers, a few unmapped segments.
+    Original positions stay below sourcelines and sourcecolumns, so maps can be cascaded.
+    '''
+    r = random.Random(seed)
+    smap = SourceMap()
+    smap.file = file
+    smap.sourceRoot = ''
+    smap.sources = ['src/module{}.js'.format(i) for i in range(sources)]
+    smap.names = ['name{}'.format(i) for i in range(names)]
+    source = sourceline = 0
+    for _ in range(lines):
+        line = []
+        column = 0
+        for _ in range(r.randint(segments // 2, segments * 3 // 2)):
+            column += r.randint(1, 12)
+            if r.random() < 0.05:
+                line.append((column,))
+                continue
+            if r.random() < 0.02:
+                source = r.randrange(sources)
+                sourceline = r.randrange(sourcelines)
+            elif r.random() < 0.3:
+                sourceline = (sourceline + 1) % sourcelines
+            sourcecolumn = r.randrange(sourcecolumns)
+            if names and r.random() < 0.3:
+                line.append((column, source, sourceline, sourcecolumn, r.randrange(names)))
+            else:
+                line.append((column, source, sourceline, sourcecolumn))
+        smap.lines.append(line)
+    return smap
+
+
+def generate_chain(depth=3, lines=2000, segments=40, sources=20, names=200, seed=0):
+    '''
+    Sourcemaps of depth build steps, the first one maps to original sources,
+    every next one maps to output of the previous step.
+    '''
+    maps = [generate_map(lines, segments, sources, names, seed, file='stage0.js')]
+    for i in range(1, depth):
+        smap = generate_map(lines, segments, 1, names, seed + i,
+                            sourcelines=lines, sourcecolumns=segments * 6, file='stage{}.js'.format(i))
+        smap.sources = ['stage{}.js'.format(i - 1)]
+        maps.append(smap)
+    return maps
+
+
+class NullWriter:
+    def write(self, data):
+        return len(data)
+
+
+def benchmarks(args):
+    '''Yield (name, function) pairs, data for functions is generated once'''
+    smap = generate_map(args.lines, args.segments, args.sources, args.names, args.seed)
+    text = smap.dump()
+    mappings = json.loads(text)['mappings']
+    compact = create_from_json(text, compact=True)
+    r = random.Random(args.seed)
+    positions = [(r.randrange(args.lines), r.randrange(args.segments * 6)) for _ in range(args.lookups)]
+    vlqs = [v for v in mappings.replace(';', ',').split(',') if v][:args.lookups * 10]
+    chain = generate_chain(args.depth, args.lines, args.segments, args.sources, args.names, args.seed)
+    pieces = [generate_map(args.lines // 10, args.segments, args.sources, args.names, args.seed + i)
+              for i in range(10)]
+    for i, piece in enumerate(pieces):
+        piece.sourceRoot = '/src/piece{}'.format(i)
+    binary = io.BytesIO()
+    smap.dump_binary(binary)
+    binary = binary.getvalue()
+
+    def lookups(m):
+        for line, column in positions:
+            try:
+                m.lookup(line, column)
+            except IndexError:
+                pass
+
+    yield 'parse_vlq64', lambda: [parse_vlq64(v) for v in vlqs]
+    yield 'decode_mappings', lambda: decode_mappings(mappings, use_numpy=False)
+    yield 'encode_mappings', lambda: encode_mappings(compact.lines, use_numpy=False)
+    if sourcemap_lib.numpy is not None:
+        yield 'decode_mappings numpy', lambda: decode_mappings(mappings, use_numpy=True)
+        yield 'encode_mappings numpy', lambda: encode_mappings(compact.lines, use_numpy=True)
+    yield 'create_from_json', lambda: create_from_json(text)
+    yield 'create_from_json compact', lambda: create_from_json(text, compact=True)
+    yield 'create_from_json lazy', lambda: create_from_json(text, lazy=True)
+    yield 'create_from_file', lambda: create_from_file(io.StringIO(text), compact=True)
+    yield 'create_from_binary', lambda: create_from_binary(binary)
+    yield 'lookup', lambda: lookups(smap)
+    yield 'lookup compact', lambda: lookups(compact)
+    yield 'lookup binary', lambda: lookups(create_from_binary(binary))
+    yield 'lookup lazy', lambda: lookups(create_from_json(text, lazy=True))
+    yield 'lookup_many', lambda: compact.lookup_many(positions)
+    yield 'dump', lambda: smap.dump()
+    yield 'dump_to', lambda: compact.dump_to(NullWriter())
+    yield 'dump_binary', lambda: compact.dump_binary(NullWriter())
+    yield 'cascade_chain', lambda: cascade_chain(*chain)
+    yield 'concat_sourcemaps', lambda: concat_sourcemaps(*pieces)
+    yield 'concat_sourcemaps compact', lambda: concat_sourcemaps(*pieces, compact=True)
+
+    def concat_writer():
+        writer = ConcatWriter(NullWriter())
+        for piece in pieces:
+            writer.add_sourcemap(piece)
+        writer.finish()
+    yield 'ConcatWriter', concat_writer
+
+    def optimize():
+        m = SourceMap()
+        m.sources, m.names, m.lines = list(compact.sources), list(compact.names), SegmentArrays(compact.lines)
+        m.optimize()
+    yield 'optimize', optimize
+
+
+def measure(func, repeat):
+    '''Return (list of run times, peak traced memory), memory is measured by separate run'''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return times, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of sourcemap library on generated sourcemaps')
+    parser.add_argument('--lines', type=int, default=2000, help='Generated lines in sourcemap')
+    parser.add_argument('--segments', type=int, default=40, help='Average segments per line')
+    parser.add_argument('--sources', type=int, default=20, help='Number of sources')
+    parser.add_argument('--names', type=int, default=200, help='Number of names')
+    parser.add_argument('--depth', type=int, default=3, help='Number of sourcemaps for cascade')
+    parser.add_argument('--lookups', type=int, default=10000, help='Number of positions for lookups')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of generator')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of every benchmark, the best one is reported')
+    parser.add_argument('--only', action='append', help='Run benchmarks with names containing this string')
+    parser.add_argument('--json', type=argparse.FileType('w'), help='Write results as JSON')
+    parser.add_argument('--compare', type=argparse.FileType('r'), help='Compare with results of previous run written by --json')
+    parser.add_argument('--fixture', help='Only write generated sourcemaps (cascade chain) to directory')
+    args = parser.parse_args()
+
+    if args.fixture is not None:
+        makedirs(args.fixture, exist_ok=True)
+        for smap in generate_chain(args.depth, args.lines, args.segments, args.sources, args.names, args.seed):
+            with open(join(args.fixture, smap.file + '.map'), 'w') as f:
+                smap.dump_to(f)
+        return
+
+    previous = {}
+    if args.compare is not None:
+        previous = {result['name']: result for result in json.load(args.compare)['results']}
+
+    results = []
+    print('{:28} {:>10} {:>10} {:>10} {:>8}'.format('benchmark', 'best, s', 'median, s', 'peak, MB', 'ratio'), file=stderr)
+    for name, func in benchmarks(args):
+        if args.only and not any(s in name for s in args.only):
+            continue
+        times, peak = measure(func, args.repeat)
+        result = {'name': name, 'best': min(times), 'median': sorted(times)[len(times) // 2], 'times': times, 'peak': peak}
+        results.append(result)
+        ratio = ''
+        if name in previous:
+            ratio = '{:.2f}'.format(result['best'] / previous[name]['best'])
+        print('{:28} {:10.4f} {:10.4f} {:10.1f} {:>8}'.format(name, result['best'], result['median'], peak / 1e6, ratio), file=stderr)
+
+    if args.json is not None:
+        params = {k: getattr(args, k) for k in ('lines', 'segments', 'sources', 'names', 'depth', 'lookups', 'seed', 'repeat')}
+        json.dump({
+            'python': platform.python_version(),
+            'numpy': getattr(sourcemap_lib.numpy, '__version__', None),
+            'params': params,
+            'results': results,
+        }, args.json, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,98 @@
+import base64
+import binascii
+import hashlib
+import io
 import json
+import mmap
+import re
+import struct
+import sys
+import tempfile
+from array import array
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from time import perf_counter
 from os.path import join, normpath, isabs
+from urllib.parse import unquote_to_bytes
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # TODO: use urldecode/urlencode for urls
 
+# lookup bias, same meaning as in other sourcemap libraries
+GREATEST_LOWER_BOUND = 1
+LEAST_UPPER_BOUND = 2
+
+
+class Stats:
+    '''
+    Collects timings of phases (read, json decode, vlq decode, encode, lookup, cascade, ...) and counters
+    of library work, it's enabled with set_stats().
+    Override add() and add_time() to send numbers somewhere else.
+    '''
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+
+    def add(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0) + seconds
+
+    @contextmanager
+    def time(self, phase):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, perf_counter() - start)
+
+    def report(self):
+        return {'timings': dict(self.timings), 'counters': dict(self.counters)}
+
+
+_stats = None
+
+
+def set_stats(stats):
+    '''Collect stats of library into Stats instance, None disables collecting. Returns previous one.'''
+    global _stats
+    previous, _stats = _stats, stats
+    return previous
+
+
+@contextmanager
+def stats_phase(phase):
+    '''Add time of block to phase when stats are collected'''
+    if _stats is None:
+        yield
+    else:
+        with _stats.time(phase):
+            yield
+
+
+def stats_count(name, value=1):
+    if _stats is not None:
+        _stats.add(name, value)
+
+
+def _timed(phase):
+    '''Decorator adding time of calls to phase when stats are collected'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _stats is None:
+                return func(*args, **kwargs)
+            with _stats.time(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
 
 base64_line = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
 base64_map = {c: i for i, c in enumerate(base64_line)}
@@ -10,42 +100,586 @@ base64_map = {c: i for i, c in enumerate(base64_line)}
 
 def parse_vlq64(v):
     result = []
-    vbytes = []
+    value = shift = 0
     for ch in v:
         b = base64_map[ch]
-        vbytes.append(b & 0x1F)
-        if not (b & 0x20):
-            vbytes.reverse()
-            value = 0
-            for x in vbytes:
-                value = (value << 5) | x
-            sgn = value & 0x1
-            value >>= 1
-            if sgn:
-                value = -value
-            result.append(value)
-            vbytes = []
-    if vbytes:
+        value += (b & 0x1F) << shift
+        if b & 0x20:
+            shift += 5
+            continue
+        result.append(-(value >> 1) if value & 1 else value >> 1)
+        value = shift = 0
+    if shift:
         raise Exception('VLQ number not finished')
     return result
 
 
+def _encode_vlq(value):
+    value = (-value << 1) | 1 if value < 0 else value << 1
+    result = ''
+    while value > 0x1F:
+        result += base64_line[(value & 0x1F) | 0x20]
+        value >>= 5
+    return result + base64_line[value]
+
+
+_vlq_cache = {}
+_vlq_cache_limit = 1 << 16
+
+
+def encode_vlq(value):
+    s = _vlq_cache.get(value)
+    if s is None:
+        s = _encode_vlq(value)
+        if -_vlq_cache_limit < value < _vlq_cache_limit:
+            _vlq_cache[value] = s
+    return s
+
+
 def dump_vlq64(values):
+    return ''.join([encode_vlq(value) for value in values])
+
+
+def parse_group(group, state):
+    '''
+    Decode one line (;-separated group) of mappings into list of segments.
+    state is a list [source, sourceline, sourcecolumn, name] carried between lines, updated in place.
+    '''
+    if group == '':
+        return []
+    if ';' in group:
+        raise SourceMapParsingException('Group must not contain line separators')
+    lines = SegmentArrays()
+    state[:] = _decode_mappings_python(group, lines, state)
+    return lines[0]
+
+
+class LazyLines:
+    '''
+    Sequence of mapping lines, used instead of list of lines in lazy mode.
+    Keeps raw mappings string and offsets of its lines, each line is decoded on first access.
+    Running source/line/column/name state is remembered for every line start already passed.
+    Lines can't be changed, only removed with pop().
+    '''
+    def __init__(self, mappings):
+        self.mappings = mappings
+        starts = array('l', [0])
+        pos = mappings.find(';')
+        while pos != -1:
+            starts.append(pos + 1)
+            pos = mappings.find(';', pos + 1)
+        self._starts = starts
+        self._states = array('l', [0, 0, 0, 0])  # 4 values per line start
+        self._cache = {}
+
+    def __len__(self):
+        return len(self._starts)
+
+    def _group(self, i):
+        start = self._starts[i]
+        if i + 1 < len(self._starts):
+            return self.mappings[start:self._starts[i + 1] - 1]
+        return self.mappings[start:]
+
+    def _state(self, i):
+        states = self._states
+        known = len(states) // 4
+        if known <= i:
+            # deltas of passed lines are only summed, their segments are not built
+            _mappings_sums(self.mappings[self._starts[known - 1]:self._starts[i]], states[-4:], states)
+        return list(states[i * 4:i * 4 + 4])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('line index out of range')
+        line = self._cache.get(i)
+        if _stats is None:
+            if line is None:
+                line = self._cache[i] = parse_group(self._group(i), self._state(i))
+        elif line is None:
+            _stats.add('lazy line misses')
+            with _stats.time('vlq decode'):
+                line = self._cache[i] = parse_group(self._group(i), self._state(i))
+        else:
+            _stats.add('lazy line hits')
+        return line
+
+    def __iter__(self):
+        states = self._states
+        state = [0, 0, 0, 0]
+        for i in range(len(self)):
+            line = parse_group(self._group(i), state)
+            if len(states) // 4 == i + 1 and i + 1 < len(self):
+                states.extend(state)
+            yield self._cache.get(i, line)
+
+    def pop(self, i=-1):
+        '''Remove line from mappings string, already decoded lines are dropped'''
+        line = self[i]
+        if i < 0:
+            i += len(self)
+        self.__init__(_drop_mappings_line(self.mappings, i))
+        return line
+
+
+class SegmentArrays:
+    '''
+    Compact columnar storage of mapping lines, can be used instead of list of lines of segment tuples.
+    Segment fields are kept in parallel integer arrays, absent fields are stored as -1.
+    offsets holds index of first segment of every line.
+    Indexing and iteration give lines as lists of segment tuples, same as in list of lines.
+    '''
+    def __init__(self, lines=()):
+        self.columns = array('i')
+        self.sources = array('i')
+        self.sourcelines = array('i')
+        self.sourcecolumns = array('i')
+        self.names = array('i')
+        self.offsets = array('l')
+        for line in lines:
+            self.append(line)
+
+    @classmethod
+    def from_fields(cls, offsets, columns, sources, sourcelines, sourcecolumns, names):
+        '''Create from sequences of line offsets and segment fields'''
+        self = cls()
+        self.offsets.extend(offsets)
+        self.columns.extend(columns)
+        self.sources.extend(sources)
+        self.sourcelines.extend(sourcelines)
+        self.sourcecolumns.extend(sourcecolumns)
+        self.names.extend(names)
+        return self
+
+    @classmethod
+    def view(cls, offsets, columns, sources, sourcelines, sourcecolumns, names):
+        '''Wrap sequences (memoryviews for example) without copying, lines of result can't be changed'''
+        self = cls.__new__(cls)
+        self.offsets = offsets
+        self.columns = columns
+        self.sources = sources
+        self.sourcelines = sourcelines
+        self.sourcecolumns = sourcecolumns
+        self.names = names
+        return self
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def line_range(self, i):
+        '''Return (start, end) segment indexes of line i'''
+        offsets = self.offsets
+        if i < 0:
+            i += len(offsets)
+        if not 0 <= i < len(offsets):
+            raise IndexError('line index out of range')
+        if i + 1 < len(offsets):
+            return offsets[i], offsets[i + 1]
+        return offsets[i], len(self.columns)
+
+    def segment(self, k):
+        if self.sources[k] < 0:
+            return (self.columns[k],)
+        if self.names[k] < 0:
+            return (self.columns[k], self.sources[k], self.sourcelines[k], self.sourcecolumns[k])
+        return (self.columns[k], self.sources[k], self.sourcelines[k], self.sourcecolumns[k], self.names[k])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        a, b = self.line_range(i)
+        return [self.segment(k) for k in range(a, b)]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def newline(self):
+        self.offsets.append(len(self.columns))
+
+    def add(self, column, source=-1, sourceline=-1, sourcecolumn=-1, name=-1):
+        '''Add segment to the end of last line'''
+        self.columns.append(column)
+        self.sources.append(source)
+        self.sourcelines.append(sourceline)
+        self.sourcecolumns.append(sourcecolumn)
+        self.names.append(name)
+
+    def append(self, line):
+        self.newline()
+        for seg in line:
+            self.add(*seg)
+
+    def pop(self, i=-1):
+        line = self[i]
+        a, b = self.line_range(i)
+        for arr in (self.columns, self.sources, self.sourcelines, self.sourcecolumns, self.names):
+            del arr[a:b]
+        offsets = self.offsets
+        if i < 0:
+            i += len(offsets)
+        del offsets[i]
+        for j in range(i, len(offsets)):
+            offsets[j] -= b - a
+        return line
+
+    def extend(self, other, sourcemap=None, namemap=None):
+        '''
+        Append all lines of other SegmentArrays.
+        sourcemap and namemap translate source and name indexes.
+        '''
+        shift = len(self.columns)
+        self.offsets.extend(array('l', [o + shift for o in other.offsets]))
+        self.columns.extend(other.columns)
+        if sourcemap is None:
+            self.sources.extend(other.sources)
+        else:
+            self.sources.extend(array('i', [sourcemap[s] if s >= 0 else -1 for s in other.sources]))
+        self.sourcelines.extend(other.sourcelines)
+        self.sourcecolumns.extend(other.sourcecolumns)
+        if namemap is None:
+            self.names.extend(other.names)
+        else:
+            self.names.extend(array('i', [namemap[n] if n >= 0 else -1 for n in other.names]))
+
+
+# Mappings codec: whole mappings string <-> SegmentArrays in one pass.
+# Digit table: base64 value, 64 for ',', 65 for ';', 66 for invalid chars
+_vlq_digits = [66] * 256
+for _i, _c in enumerate(base64_line):
+    _vlq_digits[ord(_c)] = _i
+_vlq_digits[ord(',')] = 64
+_vlq_digits[ord(';')] = 65
+_vlq_translation = bytes(_vlq_digits)
+
+
+def _continued_column(lines):
+    '''Generated column of the last segment of lines, mappings cut at ',' continue from it'''
+    if not len(lines.offsets) or lines.offsets[-1] == len(lines.columns):
+        raise SourceMapParsingException('Empty segment in mappings')
+    return lines.columns[-1]
+
+
+def _decode_mappings_python(mappings, lines, state=(0, 0, 0, 0), newline=True):
+    columns, sources, sourcelines, sourcecolumns, names = \
+        lines.columns, lines.sources, lines.sourcelines, lines.sourcecolumns, lines.names
+    source, sourceline, sourcecolumn, name = state
+    fields = []
+    value = shift = 0
+    if newline:
+        column = 0
+        lines.newline()
+        linestart = len(columns)
+    else:
+        column = _continued_column(lines)
+        linestart = -1  # the first segment must not be empty
+    # trailing separator flushes last segment, extra line is removed after loop
+    for d in (mappings.encode('ascii', 'replace') + b';').translate(_vlq_translation):
+        if d < 0x20:  # last digit of number
+            if shift:
+                value += d << shift
+                fields.append(-(value >> 1) if value & 1 else value >> 1)
+                value = shift = 0
+            else:
+                fields.append(-(d >> 1) if d & 1 else d >> 1)
+            continue
+        if d < 64:
+            value += (d & 0x1F) << shift
+            shift += 5
+            continue
+        if d == 66:
+            raise SourceMapParsingException('Invalid character in mappings')
+        if shift:
+            raise SourceMapParsingException('VLQ number not finished')
+        n = len(fields)
+        if n:
+            column += fields[0]
+            columns.append(column)
+            if n == 1:
+                sources.append(-1)
+                sourcelines.append(-1)
+                sourcecolumns.append(-1)
+                names.append(-1)
+            elif n == 4 or n == 5:
+                source += fields[1]
+                sourceline += fields[2]
+                sourcecolumn += fields[3]
+                sources.append(source)
+                sourcelines.append(sourceline)
+                sourcecolumns.append(sourcecolumn)
+                if n == 5:
+                    name += fields[4]
+                    names.append(name)
+                else:
+                    names.append(-1)
+            else:
+                raise SourceMapParsingException('Invalid segment {}'.format(fields))
+            fields = []
+        elif d == 64 or len(columns) > linestart:
+            raise SourceMapParsingException('Empty segment in mappings')
+        if d == 65:
+            column = 0
+            lines.newline()
+            linestart = len(columns)
+    del lines.offsets[-1]
+    return [source, sourceline, sourcecolumn, name]
+
+
+def _decode_mappings_numpy(mappings, lines, state=(0, 0, 0, 0), newline=True):
+    np = numpy
+    base = 0 if newline else _continued_column(lines)
+    data = np.frombuffer(mappings.encode('ascii', 'replace'), dtype=np.uint8)
+    digits = _np_vlq_digits[data]
+    if (digits == 66).any():
+        raise SourceMapParsingException('Invalid character in mappings')
+    issep = digits >= 64
+    seppos = np.flatnonzero(issep)
+    issemi = digits[seppos] == 65
+    # digits right before separators and at the end must terminate numbers
+    before = digits[seppos[seppos > 0] - 1]
+    if ((before >= 0x20) & (before < 64)).any() or (data.size and 0x20 <= digits[-1] < 64):
+        raise SourceMapParsingException('VLQ number not finished')
+
+    numpos = np.flatnonzero(~issep)
+    d = digits[numpos]
+    ends = (d & 0x20) == 0
+    startflag = np.empty(d.size, dtype=bool)
+    startflag[:1] = True
+    startflag[1:] = ends[:-1]
+    starts = np.flatnonzero(startflag)
+    numid = np.cumsum(startflag) - 1
+    shift = (np.arange(d.size) - starts[numid]) * 5
+    values = np.add.reduceat((d & 0x1F).astype(np.int64) << shift, starts) if d.size else d.astype(np.int64)
+    values = np.where(values & 1, -(values >> 1), values >> 1)
+
+    # slot is a place between separators, it is segment or nothing
+    nslots = seppos.size + 1
+    slot = np.searchsorted(seppos, numpos[starts])
+    counts = np.bincount(slot, minlength=nslots)
+    emptyok = np.ones(nslots, dtype=bool)
+    emptyok[1:] &= issemi
+    emptyok[:-1] &= issemi
+    emptyok[0] &= newline
+    bad = ((counts == 0) & ~emptyok) | ((counts != 0) & (counts != 1) & (counts != 4) & (counts != 5))
+    if bad.any():
+        raise SourceMapParsingException('Invalid segment in mappings')
+    slotline = np.zeros(nslots, dtype=np.int64)
+    slotline[1:] = np.cumsum(issemi)
+    segslots = np.flatnonzero(counts)
+    count = counts[segslots]
+    first = np.cumsum(count) - count
+    segline = slotline[segslots]
+    nlines = int(issemi.sum()) + 1
+    offsets = np.searchsorted(segline, np.arange(nlines))
+
+    dcol = values[first]
+    cs = np.cumsum(dcol)
+    linefirst = offsets[segline]
+    column = cs - cs[linefirst] + dcol[linefirst] if cs.size else cs
+    if base:
+        column[segline == 0] += base
+    has4 = count >= 4
+    has5 = count == 5
     result = []
-    for value in values:
-        sgn = 0 if value >= 0 else 1
-        if sgn:
-            value = -value
-        value = (value << 1) | sgn
-        vbytes = []
-        while value:
-            vbytes.append((value & 0x1F) | 0x20)
-            value >>= 5
-        if not vbytes:
-            vbytes = [0]
-        vbytes[-1] &= 0x1F
-        result.append(''.join(base64_line[ch] for ch in vbytes))
-    return ''.join(result)
+    endstate = []
+    for field, mask, start in zip((1, 2, 3, 4), (has4, has4, has4, has5), state):
+        arr = np.full(count.size, -1, dtype=np.intc)
+        arr[mask] = np.cumsum(values[first[mask] + field]) + start
+        result.append(arr)
+        endstate.append(int(arr[mask][-1]) if mask.any() else start)
+    offsets += len(lines.columns)
+    if not newline:
+        offsets = offsets[1:]  # the first line continues the last one of lines
+    for arr, field in zip(
+        (lines.columns, lines.sources, lines.sourcelines, lines.sourcecolumns, lines.names),
+        [column] + result
+    ):
+        arr.frombytes(field.astype(np.intc).tobytes())
+    lines.offsets.frombytes(offsets.astype('i{}'.format(lines.offsets.itemsize)).tobytes())
+    return endstate
+
+
+def _encode_mappings_python(lines, state=(0, 0, 0, 0)):
+    columns, sources, sourcelines, sourcecolumns, names = \
+        lines.columns, lines.sources, lines.sourcelines, lines.sourcecolumns, lines.names
+    cache = _vlq_cache
+    enc = encode_vlq
+    bounds = list(lines.offsets)
+    bounds.append(len(columns))
+    mappings = []
+    prevsource, prevsourceline, prevsourcecolumn, prevname = state
+    for i in range(len(bounds) - 1):
+        resultline = []
+        prevcolumn = 0
+        for k in range(bounds[i], bounds[i + 1]):
+            v = columns[k]
+            st = cache.get(v - prevcolumn) or enc(v - prevcolumn)
+            prevcolumn = v
+            v = sources[k]
+            if v >= 0:
+                st += cache.get(v - prevsource) or enc(v - prevsource)
+                prevsource = v
+                v = sourcelines[k]
+                st += cache.get(v - prevsourceline) or enc(v - prevsourceline)
+                prevsourceline = v
+                v = sourcecolumns[k]
+                st += cache.get(v - prevsourcecolumn) or enc(v - prevsourcecolumn)
+                prevsourcecolumn = v
+                v = names[k]
+                if v >= 0:
+                    st += cache.get(v - prevname) or enc(v - prevname)
+                    prevname = v
+            resultline.append(st)
+        mappings.append(','.join(resultline))
+    return ';'.join(mappings), [prevsource, prevsourceline, prevsourcecolumn, prevname]
+
+
+def _encode_mappings_numpy(lines, state=(0, 0, 0, 0)):
+    np = numpy
+    nlines = len(lines)
+    columns = np.asarray(lines.columns).astype(np.int64)
+    if not columns.size:
+        return ';' * (nlines - 1), list(state)
+    sources = np.asarray(lines.sources).astype(np.int64)
+    names = np.asarray(lines.names).astype(np.int64)
+    offsets = np.asarray(lines.offsets).astype(np.int64)
+    # line of every segment, lines without segments are skipped by searchsorted
+    segline = np.searchsorted(offsets, np.arange(columns.size), side='right') - 1
+    has4 = sources >= 0
+    has5 = has4 & (names >= 0)
+    count = 1 + has4 * 3 + has5
+    first = np.cumsum(count) - count
+
+    newline = np.ones(columns.size, dtype=bool)
+    newline[1:] = segline[1:] != segline[:-1]
+    dcol = columns.copy()
+    dcol[1:] -= np.where(newline[1:], 0, columns[:-1])
+    nums = np.empty(int(count.sum()), dtype=np.int64)
+    nums[first] = dcol
+    endstate = []
+    for field, arr, mask, start in zip(
+        (1, 2, 3, 4),
+        (sources, np.asarray(lines.sourcelines).astype(np.int64), np.asarray(lines.sourcecolumns).astype(np.int64), names),
+        (has4, has4, has4, has5),
+        state,
+    ):
+        v = arr[mask]
+        nums[first[mask] + field] = np.diff(v, prepend=start)
+        endstate.append(int(v[-1]) if v.size else start)
+
+    z = np.where(nums < 0, (-nums << 1) | 1, nums << 1)
+    ndigits = np.ones(z.size, dtype=np.uint8)
+    for k in range(1, 13):
+        ndigits += z >= (1 << (5 * k))
+    # separator before every segment: ';' for each line passed, or ','
+    seplen = np.empty(columns.size, dtype=np.int64)
+    seplen[0] = segline[0]
+    seplen[1:] = np.where(newline[1:], segline[1:] - segline[:-1], 1)
+    segdigits = np.add.reduceat(ndigits, first, dtype=np.int64)
+    segstart = np.cumsum(seplen + segdigits) - segdigits
+    tail = nlines - 1 - int(segline[-1])
+    out = np.full(int(segstart[-1] + segdigits[-1]) + tail, ord(';'), dtype=np.uint8)
+    out[(segstart - 1)[~newline]] = ord(',')
+
+    numoffset = np.cumsum(ndigits, dtype=np.int64) - ndigits
+    numstart = np.repeat(segstart - numoffset[first], count) + numoffset
+    digitnum = np.repeat(np.arange(z.size), ndigits)
+    digitidx = np.arange(digitnum.size) - np.repeat(numoffset, ndigits)
+    digits = (z[digitnum] >> (5 * digitidx)) & 0x1F
+    digits |= np.where(digitidx < ndigits[digitnum] - 1, 0x20, 0)
+    out[numstart[digitnum] + digitidx] = _np_base64_line[digits]
+    return out.tobytes().decode('ascii'), endstate
+
+
+if numpy is not None:
+    _np_vlq_digits = numpy.array(_vlq_digits, dtype=numpy.uint8)
+    _np_base64_line = numpy.frombuffer(base64_line.encode('ascii'), dtype=numpy.uint8)
+
+# numpy has noticeable setup cost, it is used only for long enough inputs
+numpy_threshold = 4096
+
+
+_separator_re = re.compile('[,;]')
+
+
+def _decode_batches(mappings, lines, state, use_numpy=None, batchsize=1 << 16, newline=True):
+    '''
+    Decode mappings into lines in pieces of about batchsize characters cut at separators,
+    so temporaries of NumPy stay small even for mappings of one long line, return state of decoder.
+    newline=False continues the last line of lines (mappings follow ',').
+    '''
+    start = 0
+    while True:
+        cut = _separator_re.search(mappings, start + batchsize) if len(mappings) - start > batchsize else None
+        piece = mappings[start:] if cut is None else mappings[start:cut.start()]
+        if use_numpy is None:
+            numpy_piece = numpy is not None and len(piece) >= numpy_threshold
+        else:
+            numpy_piece = use_numpy
+        if numpy_piece:
+            state = _decode_mappings_numpy(piece, lines, state, newline)
+        else:
+            state = _decode_mappings_python(piece, lines, state, newline)
+        if cut is None:
+            return state
+        start = cut.end()
+        newline = cut.group() == ';'
+
+
+@_timed('vlq decode')
+def decode_mappings(mappings, use_numpy=None, batchsize=1 << 16):
+    '''
+    Decode whole mappings string into SegmentArrays.
+    NumPy is used when installed, use_numpy can force either way.
+    '''
+    lines = SegmentArrays()
+    _decode_batches(mappings, lines, (0, 0, 0, 0), use_numpy, batchsize)
+    stats_count('decoded lines', len(lines))
+    stats_count('decoded segments', len(lines.columns))
+    return lines
+
+
+def encode_mappings(lines, use_numpy=None, batchsize=1 << 14):
+    '''
+    Encode lines (SegmentArrays or any sequence of lines of segment tuples) into mappings string.
+    NumPy is used when installed, use_numpy can force either way.
+    '''
+    return ''.join(iter_mappings(lines, batchsize, use_numpy))
+
+
+def iter_mappings(lines, batchsize=1 << 14, use_numpy=None):
+    '''
+    Encode lines into mappings string piece by piece, every piece covers whole lines with about batchsize segments.
+    Only one piece and copy of its segments are held in memory at a time.
+    '''
+    if not isinstance(lines, SegmentArrays):
+        lines = SegmentArrays(lines)
+    fields = (lines.columns, lines.sources, lines.sourcelines, lines.sourcecolumns, lines.names)
+    state = (0, 0, 0, 0)
+    start = 0
+    while start < len(lines):
+        a = lines.offsets[start]
+        end = max(start + 1, bisect_left(lines.offsets, a + batchsize, start))
+        b = lines.offsets[end] if end < len(lines) else len(lines.columns)
+        part = SegmentArrays.view(
+            array('l', [offset - a for offset in lines.offsets[start:end]]),
+            *[field[a:b] for field in fields]
+        )
+        if use_numpy is None:
+            numpy_part = numpy is not None and b - a >= numpy_threshold // 4
+        else:
+            numpy_part = use_numpy
+        with stats_phase('encode'):
+            if numpy_part:
+                mappings, state = _encode_mappings_numpy(part, state)
+            else:
+                mappings, state = _encode_mappings_python(part, state)
+        yield ';' + mappings if start else mappings
+        start = end
 
 
 class SourceMapParsingException(ValueError):
@@ -56,17 +690,99 @@ class SegmentNotFoundException(IndexError):
     pass
 
 
+# url_to_path and safe_join are memoized, so paths repeated in many sourcemaps are resolved once and shared
+@lru_cache(maxsize=1 << 16)
 def url_to_path(u):
     # TODO: support for absolute urls, cut off their schemes?
     return join(*u.split('/'))
 
 
+@lru_cache(maxsize=1 << 16)
 def safe_join(a, b):
     if isabs(b):
         return b
     return normpath(join(a, b))
 
 
+class SourcesContent:
+    '''
+    Sequence of sourcesContent entries, source code string or None.
+    Entries read from JSON are kept as (text, start, end) spans of their string literals and decoded on access,
+    text is str or UTF-8 buffer (memoryview of binary sourcemap).
+    Sequences made of several sourcemaps (see fill_from) refer to the same texts without copying,
+    entries with equal JSON literals are stored once.
+    '''
+    def __init__(self, entries=()):
+        self.entries = list(entries)  # None, decoded string or (text, start, end)
+        self._digests = {}  # sha1 of JSON literal: entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        entry = self.entries[i]
+        if entry is None or isinstance(entry, str):
+            return entry
+        text, start, end = entry
+        if isinstance(text, str):
+            return _json_decoder.raw_decode(text, start)[0]
+        return json.loads(str(text[start:end], 'utf-8', 'surrogatepass'))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def raw(self, i):
+        '''JSON literal of entry'''
+        entry = self.entries[i]
+        if entry is None:
+            return 'null'
+        if isinstance(entry, str):
+            return json.dumps(entry)
+        text, start, end = entry
+        if isinstance(text, str):
+            return text[start:end]
+        return str(text[start:end], 'utf-8', 'surrogatepass')
+
+    def append(self, content):
+        self.entries.append(content)
+
+    def fill_from(self, j, contents, i):
+        '''Set entry j to entry i of other sourcesContent sequence if entry j is None, so later maps can supply missing content'''
+        if self.entries[j] is not None or contents is None or i >= len(contents):
+            return
+        if isinstance(contents, SourcesContent):
+            entry, literal = contents.entries[i], contents.raw(i)
+        else:
+            entry, literal = contents[i], json.dumps(contents[i])
+        if entry is not None:
+            digest = hashlib.sha1(literal.encode('utf-8', 'surrogatepass')).digest()
+            self.entries[j] = self._digests.setdefault(digest, entry)
+
+    def has_content(self):
+        return any(entry is not None for entry in self.entries)
+
+
+def _take_contents(contents, indexes):
+    '''Entries of sourcesContent sequence at indexes, entries of SourcesContent are not decoded'''
+    if isinstance(contents, SourcesContent):
+        entries = contents.entries
+        return SourcesContent(entries[i] if i < len(entries) else None for i in indexes)
+    return [contents[i] if i < len(contents) else None for i in indexes]
+
+
+def _content_literals(contents):
+    '''JSON literals of sourcesContent sequence'''
+    if isinstance(contents, SourcesContent):
+        for i in range(len(contents)):
+            yield contents.raw(i)
+    else:
+        for content in contents:
+            yield json.dumps(content)
+
+
 class SourceMap:
     def __init__(self):
         self.file = None
@@ -74,79 +790,598 @@ class SourceMap:
         self.sources = []
         self.names = []
         self.lines = []
+        self.sourcesContent = None  # sequence parallel to sources or None
+        self._column_index = {}
+        self._reverse_index = None
+        self._source_paths = None
+        self._path_indexes = None
 
-    def lookup(self, line, column, useSourceRoot=True):
-        if column < 0:
-            raise ValueError('Column can not be negative')
-        seglist = self.lines[line]
-        a, b = 0, len(seglist)
-        seg = None
-        while b - a > 0:
-            c = (a + b) // 2
-            if seglist[c][0] <= column and (c >= len(seglist) - 1 or column < seglist[c + 1][0]):
-                seg = seglist[c]
-                break
-            elif column < seglist[c][0]:
-                b = c
-            else:
-                a = c + 1
-        if seg is None:
-            raise SegmentNotFoundException
-        if len(seg) == 1:
-            # return None # segment without any link
-            raise SegmentNotFoundException
+    def source_paths(self):
+        '''
+        Sources joined with sourceRoot and normalized. Table is built on first use
+        and kept while sourceRoot and sources list are unchanged.
+        '''
+        entry = self._source_paths
+        sources = self.sources
+        if entry is None or entry[0] != self.sourceRoot or entry[1] is not sources or len(entry[2]) != len(sources):
+            root = self.sourceRoot or ''
+            entry = self._source_paths = (self.sourceRoot, sources, [safe_join(root, source) for source in sources])
+        return entry[2]
+
+    def _source_index(self, source):
+        '''Index of source given as listed in sources or joined with sourceRoot, None if it's unknown'''
+        paths = self.source_paths()
+        entry = self._path_indexes
+        if entry is None or entry[0] is not paths:
+            indexes = {}
+            for i, (name, path) in enumerate(zip(self.sources, paths)):
+                indexes.setdefault(name, i)
+                indexes.setdefault(path, i)
+            entry = self._path_indexes = (paths, indexes)
+        return entry[1].get(source)
+
+    def source_content(self, source):
+        '''
+        Code of source from sourcesContent, only this entry is decoded. None if code is not embedded.
+        source is index or source as listed in sources or joined with sourceRoot.
+        '''
+        if self.sourcesContent is None:
+            return None
+        if not isinstance(source, int):
+            source = self._source_index(source)
+            if source is None:
+                return None
+        if not 0 <= source < len(self.sourcesContent):
+            return None
+        return self.sourcesContent[source]
+
+    def _line_index(self, line):
+        '''
+        Return (columns, lo, hi), columns[lo:hi] are sorted starting columns of segments of line.
+        For list lines column arrays are built on first use and kept while line list is unchanged.
+        '''
+        lines = self.lines
+        if isinstance(lines, SegmentArrays):
+            lo, hi = lines.line_range(line)
+            return lines.columns, lo, hi
+        seglist = lines[line]
+        if line < 0:
+            line += len(lines)
+        entry = self._column_index.get(line)
+        if entry is None or entry[0] is not seglist or len(entry[1]) != len(seglist):
+            stats_count('column index misses')
+            entry = self._column_index[line] = (seglist, array('i', [seg[0] for seg in seglist]))
+        elif _stats is not None:
+            _stats.add('column index hits')
+        return entry[1], 0, len(seglist)
+
+    def _segment(self, line, k):
+        if isinstance(self.lines, SegmentArrays):
+            return self.lines.segment(k)
+        return self.lines[line][k]
+
+    def _find_segment(self, line, column, bias=GREATEST_LOWER_BOUND):
+        columns, lo, hi = self._line_index(line)
+        if bias == GREATEST_LOWER_BOUND:
+            k = bisect_right(columns, column, lo, hi) - 1
+            if k < lo:
+                raise SegmentNotFoundException
+        elif bias == LEAST_UPPER_BOUND:
+            k = bisect_left(columns, column, lo, hi)
+            if k >= hi:
+                raise SegmentNotFoundException
+        else:
+            raise ValueError('Unknown bias {}'.format(bias))
+        return self._segment(line, k)
+
+    def _result(self, seg, useSourceRoot):
         result = {
-            'source': self.sources[seg[1]],
+            'source': self.source_paths()[seg[1]] if useSourceRoot else self.sources[seg[1]],
             'line': seg[2],
             'column': seg[3],
         }
-        if useSourceRoot:
-            result['source'] = safe_join(self.sourceRoot, result['source'])
         if len(seg) > 4:
             result['name'] = seg[4]
         return result
 
-    def dump(self, serialize=True):
-        # TODO: cleanup unused references
-        # TODO: cleanup zero-len segments
-        # TODO: merge same target segments
-        mappings = []
-        prevsource, prevsourceline, prevsourcecolumn, prevname = 0, 0, 0, 0
-        for line in self.lines:
-            resultline = []
-            prevcolumn = 0
-            for seg in line:
-                st = [seg[0] - prevcolumn]
-                prevcolumn = seg[0]
-                if len(seg) > 1:
-                    st.append(seg[1] - prevsource)
-                    st.append(seg[2] - prevsourceline)
-                    st.append(seg[3] - prevsourcecolumn)
-                    prevsource, prevsourceline, prevsourcecolumn = seg[1:4]
-                if len(seg) > 4:
-                    st.append(seg[4] - prevname)
-                    prevname = seg[4]
-                resultline.append(dump_vlq64(st))
-            mappings.append(','.join(resultline))
-        mapdata = {
+    def lookup(self, line, column, useSourceRoot=True, bias=GREATEST_LOWER_BOUND):
+        '''
+        Find original position for given generated position.
+        With GREATEST_LOWER_BOUND bias segment starting at or before column is used (the one containing column),
+        with LEAST_UPPER_BOUND - segment starting at or after column.
+        '''
+        if column < 0:
+            raise ValueError('Column can not be negative')
+        if _stats is not None:
+            _stats.add('lookups')
+        try:
+            seg = self._find_segment(line, column, bias)
+        except IndexError:
+            stats_count('lookup misses')
+            raise
+        if len(seg) == 1:
+            # return None # segment without any link
+            stats_count('lookup misses')
+            raise SegmentNotFoundException
+        return self._result(seg, useSourceRoot)
+
+    def lookup_range(self, line, column, endcolumn, useSourceRoot=True):
+        '''
+        Find all original positions covering generated span [column, endcolumn) of line.
+        Returns list of lookup results extended with generatedColumn of segment, segments without link are skipped.
+        '''
+        if column < 0:
+            raise ValueError('Column can not be negative')
+        columns, lo, hi = self._line_index(line)
+        k = max(lo, bisect_right(columns, column, lo, hi) - 1)
+        end = bisect_left(columns, endcolumn, k, hi)
+        result = []
+        for k in range(k, end):
+            seg = self._segment(line, k)
+            if len(seg) > 1:
+                lk = self._result(seg, useSourceRoot)
+                lk['generatedColumn'] = seg[0]
+                result.append(lk)
+        return result
+
+    def lookup_many(self, positions, useSourceRoot=True, bias=GREATEST_LOWER_BOUND):
+        '''
+        Lookup for many (line, column) positions at once.
+        Positions are grouped by line, so column index of every line is fetched once and
+        every segment is turned into result once, positions are not sorted.
+        Returns list of lookup results in order of positions, None for positions not found.
+        Positions resolved to the same segment share result dict.
+        '''
+        if bias not in (GREATEST_LOWER_BOUND, LEAST_UPPER_BOUND):
+            raise ValueError('Unknown bias {}'.format(bias))
+        nlines = len(self.lines)
+        bylines = {}  # line: [(position index, column), ...]
+        for i, (line, column) in enumerate(positions):
+            if column < 0:
+                raise ValueError('Column can not be negative')
+            if line < 0:
+                line += nlines
+            group = bylines.get(line)
+            if group is None:
+                group = bylines[line] = []
+            group.append((i, column))
+        results = [None] * len(positions)
+        segcache = {}  # segment index: result
+        upper = bias == LEAST_UPPER_BOUND
+        lines = self.lines
+        compact = isinstance(lines, SegmentArrays)
+        paths = self.source_paths() if useSourceRoot else self.sources
+        for line, group in bylines.items():
+            if not 0 <= line < nlines:
+                continue
+            columns, lo, hi = self._line_index(line)
+            for i, column in group:
+                if upper:
+                    k = bisect_left(columns, column, lo, hi)
+                    if k >= hi:
+                        continue
+                else:
+                    k = bisect_right(columns, column, lo, hi) - 1
+                    if k < lo:
+                        continue
+                # segment indexes of list lines start from 0 on every line
+                key = k if lo else (line, k)
+                result = segcache.get(key, segcache)
+                if result is segcache:
+                    # same as _result, source table is fetched once
+                    seg = lines.segment(k) if compact else lines[line][k]
+                    if len(seg) == 1:
+                        result = None
+                    else:
+                        result = {'source': paths[seg[1]], 'line': seg[2], 'column': seg[3]}
+                        if len(seg) > 4:
+                            result['name'] = seg[4]
+                    segcache[key] = result
+                results[i] = result
+        stats_count('lookups', len(results))
+        stats_count('lookup misses', results.count(None))
+        return results
+
+    def _reverse(self):
+        '''
+        Reverse index {(source index, original line): (sorted original columns, [(column, line, generated column), ...])}
+        It's built on first use and reflects lines at that moment.
+        '''
+        if self._reverse_index is None:
+            entries = {}
+            lines = self.lines
+            if isinstance(lines, SegmentArrays):
+                columns, sources, sourcelines, sourcecolumns = \
+                    lines.columns, lines.sources, lines.sourcelines, lines.sourcecolumns
+                for line in range(len(lines)):
+                    for k in range(*lines.line_range(line)):
+                        if sources[k] >= 0:
+                            key = (sources[k], sourcelines[k])
+                            item = (sourcecolumns[k], line, columns[k])
+                            if key in entries:
+                                entries[key].append(item)
+                            else:
+                                entries[key] = [item]
+            else:
+                for line, seglist in enumerate(lines):
+                    for seg in seglist:
+                        if len(seg) > 1:
+                            key = (seg[1], seg[2])
+                            item = (seg[3], line, seg[0])
+                            if key in entries:
+                                entries[key].append(item)
+                            else:
+                                entries[key] = [item]
+            for key, items in entries.items():
+                items.sort()
+                entries[key] = (array('i', [item[0] for item in items]), items)
+            self._reverse_index = entries
+        return self._reverse_index
+
+    def _reverse_entry(self, source, line):
+        index = self._reverse()
+        if not isinstance(source, int):
+            name, source = source, self._source_index(source)
+            if source is None:
+                raise ValueError('Unknown source {}'.format(name))
+        if (source, line) not in index:
+            raise SegmentNotFoundException
+        return index[source, line]
+
+    def original_to_generated(self, source, line, column, bias=GREATEST_LOWER_BOUND):
+        '''
+        Find generated position for original one.
+        source is index in sources, source as in sources or source joined with sourceRoot.
+        Returns {'line': ..., 'column': ...} of first generated position for closest original column.
+        '''
+        columns, items = self._reverse_entry(source, line)
+        if bias == GREATEST_LOWER_BOUND:
+            k = bisect_right(columns, column) - 1
+            if k < 0:
+                raise SegmentNotFoundException
+            k = bisect_left(columns, columns[k])
+        elif bias == LEAST_UPPER_BOUND:
+            k = bisect_left(columns, column)
+            if k >= len(columns):
+                raise SegmentNotFoundException
+        else:
+            raise ValueError('Unknown bias {}'.format(bias))
+        return {'line': items[k][1], 'column': items[k][2]}
+
+    def all_generated_positions_for(self, source, line, column=None):
+        '''
+        Find all generated positions for original line, or for original line and column.
+        When there is no mapping for exactly given column, positions for the closest following column are returned.
+        '''
+        try:
+            columns, items = self._reverse_entry(source, line)
+        except SegmentNotFoundException:
+            return []
+        if column is None:
+            a, b = 0, len(items)
+        else:
+            a = bisect_left(columns, column)
+            if a >= len(columns):
+                return []
+            b = bisect_right(columns, columns[a], a)
+        return [{'line': item[1], 'column': item[2]} for item in items[a:b]]
+
+    def _mapdata(self, mappings):
+        return {
             'version': 3,
             'file': '' if self.file is None else self.file,
             'sourceRoot': '' if self.sourceRoot is None else self.sourceRoot,
-            'sources': self.sources.copy(),
-            'names': self.names.copy(),
-            'mappings': ';'.join(mappings),
+            'sources': list(self.sources),
+            'names': list(self.names),
+            'mappings': mappings,
         }
+
+    @_timed('optimize')
+    def optimize(self, coalesce=True):
+        '''
+        Make sourcemap smaller, lookups with GREATEST_LOWER_BOUND bias keep their results:
+        - zero-length segments (followed by segment at the same column) are dropped
+        - segments with the same original position and name as previous one are merged into it,
+          unmapped segments following unmapped ones too
+        - sources and names not used by segments are removed
+        With coalesce=True segments continuing original position of previous one (same source line and name,
+        original column moved by the same distance as generated one) are merged too,
+        positions inside them are resolved to start of the merged segment.
+        '''
+        lines = self.lines
+        if not isinstance(lines, SegmentArrays):
+            lines = SegmentArrays(lines)
+        columns, sources, sourcelines, sourcecolumns, names = \
+            lines.columns, lines.sources, lines.sourcelines, lines.sourcecolumns, lines.names
+        keep = []
+        for i in range(len(lines)):
+            a, b = lines.line_range(i)
+            prev = None  # last kept segment of line
+            for k in range(a, b):
+                if k + 1 < b and columns[k + 1] == columns[k]:
+                    continue
+                if prev is not None:
+                    source = sources[k]
+                    if source < 0:
+                        if sources[prev] < 0:
+                            continue
+                    elif source == sources[prev] and sourcelines[k] == sourcelines[prev] and names[k] == names[prev]:
+                        if sourcecolumns[k] == sourcecolumns[prev]:
+                            continue
+                        if coalesce and sourcecolumns[k] - sourcecolumns[prev] == columns[k] - columns[prev]:
+                            continue
+                prev = k
+                keep.append(k)
+
+        sourceindexes = [-1] * len(self.sources)
+        nameindexes = [-1] * len(self.names)
+        for k in keep:
+            if sources[k] >= 0:
+                sourceindexes[sources[k]] = 0
+            if names[k] >= 0:
+                nameindexes[names[k]] = 0
+        newsources = []
+        kept = []
+        for i, used in enumerate(sourceindexes):
+            if used == 0:
+                sourceindexes[i] = len(newsources)
+                newsources.append(self.sources[i])
+                kept.append(i)
+        newnames = []
+        for i, used in enumerate(nameindexes):
+            if used == 0:
+                nameindexes[i] = len(newnames)
+                newnames.append(self.names[i])
+
+        offsets = array('l')
+        k = 0
+        for i in range(len(lines)):
+            offsets.append(k)
+            a, b = lines.line_range(i)
+            k = bisect_left(keep, b, k)
+        result = SegmentArrays.from_fields(
+            offsets,
+            [columns[k] for k in keep],
+            [sourceindexes[sources[k]] if sources[k] >= 0 else -1 for k in keep],
+            [sourcelines[k] for k in keep],
+            [sourcecolumns[k] for k in keep],
+            [nameindexes[names[k]] if names[k] >= 0 else -1 for k in keep],
+        )
+        stats_count('optimized segments', len(columns) - len(keep))
+        if self.sourcesContent is not None:
+            self.sourcesContent = _take_contents(self.sourcesContent, kept)
+        self.sources = newsources
+        self.names = newnames
+        self.lines = result if isinstance(self.lines, SegmentArrays) else list(result)
+        self._column_index = {}
+        self._reverse_index = None
+
+    def dump(self, serialize=True):
+        '''
+        Return sourcemap JSON, or dict with serialize=False.
+        sourcesContent is written from raw JSON literals (see dump_to), only the dict has it decoded.
+        '''
+        if serialize and self.sourcesContent is not None:
+            buf = io.StringIO()
+            self.dump_to(buf)
+            return buf.getvalue()
+        if isinstance(self.lines, LazyLines):
+            mappings = self.lines.mappings
+        else:
+            mappings = encode_mappings(self.lines)
+        mapdata = self._mapdata(mappings)
         if serialize:
-            return json.dumps(mapdata)
+            with stats_phase('json encode'):
+                return json.dumps(mapdata)
+        if self.sourcesContent is not None:
+            mapdata['sourcesContent'] = list(self.sourcesContent)
         return mapdata
 
+    def dump_to(self, fileobj):
+        '''
+        Write same JSON as dump() to text file object.
+        Mappings are encoded and written piece by piece (see iter_mappings) instead of building whole string.
+        '''
+        head = json.dumps(self._mapdata(''))
+        with stats_phase('write'):
+            fileobj.write(head[:-2])  # up to opening quote of mappings
+        if isinstance(self.lines, LazyLines):
+            with stats_phase('write'):
+                fileobj.write(self.lines.mappings)
+        else:
+            for piece in iter_mappings(self.lines):
+                with stats_phase('write'):
+                    fileobj.write(piece)
+        with stats_phase('write'):
+            if self.sourcesContent is None:
+                fileobj.write(head[-2:])
+            else:
+                _write_contents(fileobj, '", "sourcesContent": [', self.sourcesContent, ']}')
+
+    def dump_binary(self, fileobj):
+        '''Write sourcemap in binary format (see create_from_binary) to file opened in binary mode'''
+        lines = self.lines
+        if not isinstance(lines, SegmentArrays):
+            lines = SegmentArrays(lines)
+        nsegments = len(lines.columns)
+        records = array('i', [0]) * (5 * nsegments)
+        for field, arr in enumerate((lines.columns, lines.sources, lines.sourcelines, lines.sourcecolumns, lines.names)):
+            records[field::5] = arr if isinstance(arr, array) and arr.typecode == 'i' else array('i', arr)
+        offsets = array('i', lines.offsets)
+        strings = [(self.file or '').encode('utf-8'), (self.sourceRoot or '').encode('utf-8')]
+        strings.extend(source.encode('utf-8') for source in self.sources)
+        strings.extend(name.encode('utf-8') for name in self.names)
+        stroffsets = array('i', [0])
+        for string in strings:
+            stroffsets.append(stroffsets[-1] + len(string))
+        if sys.byteorder != 'little':
+            for arr in (offsets, records, stroffsets):
+                arr.byteswap()
+        fileobj.write(_binary_header.pack(BINARY_MAGIC, len(lines), nsegments, len(self.sources), len(self.names)))
+        fileobj.write(offsets.tobytes())
+        fileobj.write(records.tobytes())
+        fileobj.write(stroffsets.tobytes())
+        fileobj.write(b''.join(strings))
+        if self.sourcesContent is not None:
+            literals = [literal.encode('utf-8', 'surrogatepass') for literal in _content_literals(self.sourcesContent)]
+            contentoffsets = array('i', [len(literals), 0])
+            for literal in literals:
+                contentoffsets.append(contentoffsets[-1] + len(literal))
+            if sys.byteorder != 'little':
+                contentoffsets.byteswap()
+            fileobj.write(contentoffsets.tobytes())
+            fileobj.write(b''.join(literals))
+
+
+class IndexMap(SourceMap):
+    '''
+    Sourcemap made of sections (index map), each section is SourceMap placed at (line, column) offset.
+    Lookups are dispatched to sections by bisecting on their offsets.
+    sources and names are merged tables of all sections, sources are joined with sourceRoot of their section.
+    lines of all sections are merged into SegmentArrays on first access, so everything else works as for plain sourcemap.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.sourceRoot = ''
+        self.sections = []
+        self._offsets = []
+        self._indexes = []  # (source indexes, name indexes) translating section tables into merged ones
+        self._sourcemap = {}
+        self._namemap = {}
+        self._lines = None
+        self.sourcesContent = None
+
+    @property
+    def lines(self):
+        if self._lines is None:
+            self._lines = self._merge_lines()
+        return self._lines
+
+    @lines.setter
+    def lines(self, value):
+        self._lines = value
+
+    def add_section(self, line, column, smap):
+        '''Sections must be added in order of their offsets'''
+        if self._offsets and (line, column) <= self._offsets[-1]:
+            raise SourceMapParsingException('Sections must be ordered by offset and must not overlap')
+        if smap.sourcesContent is not None and self.sourcesContent is None:
+            self.sourcesContent = SourcesContent([None] * len(self.sources))
+        sourceindexes = []
+        for i, source in enumerate(smap.source_paths()):
+            if source not in self._sourcemap:
+                self._sourcemap[source] = len(self.sources)
+                self.sources.append(source)
+                if self.sourcesContent is not None:
+                    self.sourcesContent.append(None)
+            sourceindexes.append(self._sourcemap[source])
+            if self.sourcesContent is not None:
+                self.sourcesContent.fill_from(self._sourcemap[source], smap.sourcesContent, i)
+        nameindexes = []
+        for name in smap.names:
+            if name not in self._namemap:
+                self._namemap[name] = len(self.names)
+                self.names.append(name)
+            nameindexes.append(self._namemap[name])
+        self.sections.append((line, column, smap))
+        self._offsets.append((line, column))
+        self._indexes.append((sourceindexes, nameindexes))
+        self._lines = None
+        self._column_index = {}
+        self._reverse_index = None
+
+    def optimize(self, coalesce=True):
+        '''
+        Optimize every section in place (see SourceMap.optimize) and rebuild merged sources and names,
+        so sources and names no longer used by any section are dropped.
+        Segments are not coalesced across section boundaries.
+        '''
+        sections = self.sections
+        self.sources, self.names, self.sourcesContent = [], [], None
+        self.sections, self._offsets, self._indexes = [], [], []
+        self._sourcemap, self._namemap = {}, {}
+        for line, column, smap in sections:
+            smap.optimize(coalesce)
+            self.add_section(line, column, smap)
+
+    def _section(self, line, column):
+        k = bisect_right(self._offsets, (line, column)) - 1
+        if k < 0:
+            raise SegmentNotFoundException
+        return k
+
+    def _find_segment(self, line, column, bias=GREATEST_LOWER_BOUND):
+        k = self._section(line, column)
+        sline, scol, smap = self.sections[k]
+        shift = scol if line == sline else 0
+        seg = smap._find_segment(line - sline, column - shift, bias)
+        if len(seg) == 1:
+            return (seg[0] + shift,)
+        sourceindexes, nameindexes = self._indexes[k]
+        if len(seg) == 4:
+            return (seg[0] + shift, sourceindexes[seg[1]], seg[2], seg[3])
+        return (seg[0] + shift, sourceindexes[seg[1]], seg[2], seg[3], nameindexes[seg[4]])
+
+    def lookup_many(self, positions, useSourceRoot=True, bias=GREATEST_LOWER_BOUND):
+        '''Same as SourceMap.lookup_many, every position is dispatched to its section'''
+        if bias not in (GREATEST_LOWER_BOUND, LEAST_UPPER_BOUND):
+            raise ValueError('Unknown bias {}'.format(bias))
+        results = []
+        for line, column in positions:
+            if column < 0:
+                raise ValueError('Column can not be negative')
+            try:
+                seg = self._find_segment(line, column, bias)
+            except IndexError:
+                results.append(None)
+                continue
+            results.append(None if len(seg) == 1 else self._result(seg, useSourceRoot))
+        stats_count('lookups', len(results))
+        stats_count('lookup misses', results.count(None))
+        return results
+
+    def _merge_lines(self):
+        '''Place lines of all sections at their offsets, every section is cut at offset of the next one'''
+        lines = SegmentArrays()
+        for k, (sline, scol, smap) in enumerate(self.sections):
+            sourceindexes, nameindexes = self._indexes[k]
+            end = self._offsets[k + 1] if k + 1 < len(self._offsets) else None
+            while len(lines) <= sline:
+                lines.newline()
+            for i, seglist in enumerate(smap.lines):
+                line = sline + i
+                if end is not None and line > end[0]:
+                    break
+                if i:
+                    lines.newline()
+                shift = scol if i == 0 else 0
+                for seg in seglist:
+                    column = seg[0] + shift
+                    if end is not None and (line, column) >= end:
+                        break
+                    if len(seg) == 1:
+                        lines.add(column)
+                    elif len(seg) == 4:
+                        lines.add(column, sourceindexes[seg[1]], seg[2], seg[3])
+                    else:
+                        lines.add(column, sourceindexes[seg[1]], seg[2], seg[3], nameindexes[seg[4]])
+        return lines
 
-def create_from_json(jsondata):
+
+def create_from_json(jsondata, lazy=False, compact=False):
+    '''
+    lazy=True keeps mappings undecoded until lines are accessed (see LazyLines),
+    compact=True stores lines as SegmentArrays.
+    '''
+    if lazy and compact:
+        raise ValueError('Lazy and compact modes can not be combined')
     self = SourceMap()
     if not isinstance(jsondata, dict):
-        jsondata = json.loads(jsondata)
+        jsondata = _loads_sourcemap(jsondata)
     if jsondata.get('version') != 3:
         raise SourceMapParsingException('Bad sourcemap version')
+    if 'sections' in jsondata:
+        return _create_index_map(jsondata, lazy, compact)
     # TODO: move to json schema
     for k in ('file', 'sourceRoot'):
         v = jsondata.get(k, '')
@@ -165,78 +1400,573 @@ def create_from_json(jsondata):
         if k == 'sources':
             v = [url_to_path(vv) for vv in v]
         setattr(self, k, v)
+    contents = jsondata.get('sourcesContent')
+    if contents is not None and not isinstance(contents, SourcesContent):
+        if not isinstance(contents, list):
+            raise SourceMapParsingException('Parameter sourcesContent must be array')
+        for vv in contents:
+            if vv is not None and not isinstance(vv, str):
+                raise SourceMapParsingException('Array element {} inside sourcesContent must be string or null'.format(vv))
+    self.sourcesContent = contents
 
-    self.lines = []
-    column, source, sourceline, sourcecolumn, name = 0, 0, 0, 0, 0
-    for group in jsondata['mappings'].split(';'):
-        if group == '':
-            self.lines.append([])
-            continue
-        column = 0
-        linegroup = []
-        for seg in group.split(','):
-            segp = parse_vlq64(seg)
-
-            column += segp[0]
-            if len(segp) >= 4:
-                source += segp[1]
-                sourceline += segp[2]
-                sourcecolumn += segp[3]
-            if len(segp) == 5:
-                name += segp[4]
-
-            if len(segp) == 1:
-                x = (column,)
-            elif len(segp) == 4:
-                x = (column, source, sourceline, sourcecolumn)
-            elif len(segp) == 5:
-                x = (column, source, sourceline, sourcecolumn, name)
+    if lazy:
+        self.lines = LazyLines(jsondata['mappings'])
+        return self
+    self.lines = decode_mappings(jsondata['mappings'])
+    if not compact:
+        self.lines = list(self.lines)
+    return self
+
+
+def _create_index_map(jsondata, lazy, compact):
+    self = IndexMap()
+    file = jsondata.get('file', '')
+    if not isinstance(file, str):
+        raise SourceMapParsingException('Parameter file must be string')
+    self.file = file
+    sections = jsondata['sections']
+    if not isinstance(sections, list):
+        raise SourceMapParsingException('Parameter sections must be array')
+    for section in sections:
+        if not isinstance(section, dict):
+            raise SourceMapParsingException('Section must be object')
+        if 'url' in section:
+            raise SourceMapParsingException('Sections with url are not supported')
+        offset = section.get('offset')
+        if not isinstance(offset, dict) or \
+                not isinstance(offset.get('line'), int) or not isinstance(offset.get('column'), int):
+            raise SourceMapParsingException('Section offset must have integer line and column')
+        if 'map' not in section:
+            raise SourceMapParsingException('Section must have map')
+        self.add_section(offset['line'], offset['column'], create_from_json(section['map'], lazy, compact))
+    return self
+
+
+def dump_index_map(sections, file='', serialize=True):
+    '''
+    Create index map from list of (line, column, SourceMap) sections.
+    Mappings of sections are not merged, sourcemaps in lazy mode are dumped without encoding.
+    '''
+    mapdata = {
+        'version': 3,
+        'file': file,
+        'sections': [
+            {'offset': {'line': line, 'column': column}, 'map': smap.dump(serialize=False)}
+            for line, column, smap in sections
+        ],
+    }
+    if serialize:
+        return json.dumps(mapdata)
+    return mapdata
+
+
+_json_decoder = json.JSONDecoder()
+_whitespace_re = re.compile(r'[ \t\n\r]*')
+
+
+def _write_contents(fileobj, head, contents, tail):
+    '''Write JSON literals of sourcesContent sequence as array between head and tail'''
+    fileobj.write(head)
+    for i, literal in enumerate(_content_literals(contents)):
+        if i:
+            fileobj.write(', ')
+        fileobj.write(literal)
+    fileobj.write(tail)
+
+
+class _ChunkReader:
+    '''Reads JSON text from file by chunks, consumed part of buffer is dropped when next chunk is read'''
+    def __init__(self, fileobj, chunksize, buf=''):
+        self.fileobj = fileobj
+        self.chunksize = chunksize
+        self.buf = buf
+        self.pos = 0
+
+    def more(self, size=None):
+        '''Read next chunk, return False at end of file'''
+        with stats_phase('read'):
+            chunk = self.fileobj.read(size or self.chunksize)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return bool(chunk)
+
+    def peek(self):
+        '''Skip whitespace, return next character'''
+        while True:
+            self.pos = _whitespace_re.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.more():
+                raise SourceMapParsingException('Unexpected end of JSON')
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise SourceMapParsingException('Invalid JSON: unexpected {!r}'.format(c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        '''Decode whole JSON value at current position'''
+        self.peek()
+        while True:
+            try:
+                with stats_phase('json decode'):
+                    value, end = _json_decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                end = None
+            # value can be cut by end of buffer, number for example
+            if end is not None and end < len(self.buf):
+                self.pos = end
+                return value
+            # buffer is at least doubled, so long values are not decoded again too many times
+            if not self.more(max(self.chunksize, len(self.buf))):
+                if end is None:
+                    raise SourceMapParsingException('Invalid JSON')
+                self.pos = end
+                return value
+
+    def mappings(self, lines, use_numpy=None):
+        '''
+        Decode mappings string starting at current position into lines, return state of decoder.
+        Every decoded piece ends with separator or with end of string, piece following ',' continues
+        the last line of lines, so mappings of one long line are decoded by pieces too.
+        '''
+        state = [0, 0, 0, 0]
+        newline = True
+        while True:
+            end = self.buf.find('"', self.pos)
+            if end == -1:
+                end = max(self.buf.rfind(';', self.pos), self.buf.rfind(',', self.pos))
+                if end == -1:
+                    if not self.more():
+                        raise SourceMapParsingException('Unexpected end of JSON')
+                    continue
+            piece = self.buf[self.pos:end]
+            last = self.buf[end] == '"'
+            self.pos = end + 1
+            if '\\' in piece:
+                piece = json.loads('"' + piece + '"')
+            with stats_phase('vlq decode'):
+                state = _decode_batches(piece, lines, state, use_numpy, newline=newline)
+            if last:
+                return state
+            newline = self.buf[end] == ';'
+            if self.pos >= len(self.buf):
+                self.more()
+
+    def sources_content(self):
+        '''
+        Read array of strings and nulls at current position without decoding strings,
+        return SourcesContent referring to one text made of their JSON literals.
+        '''
+        self.expect('[')
+        pieces = []
+        spans = []
+        size = 0
+        if self.peek() == ']':
+            self.pos += 1
+            return SourcesContent()
+        while True:
+            c = self.peek()
+            if c == '"':
+                # C scanner of json module finds end of string faster than regex, decoded string is dropped
+                while True:
+                    try:
+                        end = json.decoder.scanstring(self.buf, self.pos + 1)[1]
+                        break
+                    except json.JSONDecodeError:
+                        if not self.more(max(self.chunksize, len(self.buf))):
+                            raise SourceMapParsingException('Invalid string inside sourcesContent')
+                pieces.append(self.buf[self.pos:end])
+                spans.append((size, size + len(pieces[-1])))
+                size += len(pieces[-1])
+                self.pos = end
+            elif c == 'n' and self.value() is None:
+                spans.append(None)
             else:
-                raise Exception('Invalid segment {}'.format(segp))
+                raise SourceMapParsingException('Array element inside sourcesContent must be string or null')
+            if self.expect(',]') == ']':
+                break
+        text = ''.join(pieces)
+        return SourcesContent(None if span is None else (text, span[0], span[1]) for span in spans)
 
-            linegroup.append(x)
-        self.lines.append(linegroup)
+    def sourcemap(self, lines=None, use_numpy=None):
+        '''
+        Decode JSON object of sourcemap at current position, sourcesContent is kept undecoded (see sources_content).
+        If lines are given, mappings string is decoded into them and lines are set as mappings in result.
+        '''
+        jsondata = {}
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return jsondata
+        while True:
+            if self.peek() != '"':
+                raise SourceMapParsingException('Invalid JSON: object key expected')
+            key = self.value()
+            self.expect(':')
+            if key == 'mappings' and lines is not None and self.peek() == '"':
+                self.pos += 1
+                self.mappings(lines, use_numpy)
+                stats_count('decoded lines', len(lines))
+                stats_count('decoded segments', len(lines.columns))
+                jsondata[key] = lines
+            elif key == 'sourcesContent' and self.peek() == '[':
+                jsondata[key] = self.sources_content()
+            else:
+                jsondata[key] = self.value()
+            if self.expect(',}') == '}':
+                return jsondata
+
+
+def _loads_sourcemap(text):
+    '''json.loads for sourcemap JSON text, sourcesContent strings are not decoded'''
+    if isinstance(text, (bytes, bytearray)):
+        text = text.decode(json.detect_encoding(text), 'surrogatepass')
+    reader = _ChunkReader(io.StringIO(), 1 << 20, text)
+    jsondata = reader.sourcemap()
+    if _whitespace_re.match(reader.buf, reader.pos).end() != len(reader.buf):
+        raise SourceMapParsingException('Invalid JSON: extra data after sourcemap')
+    return jsondata
+
+
+def create_from_file(fileobj, compact=False, chunksize=1 << 20, use_numpy=None):
+    '''
+    Load sourcemap from file object, reading it by chunks of chunksize characters.
+    mappings string is decoded piece by piece as it is read, so neither the whole file nor the whole
+    mappings string are kept in memory. Other values are decoded whole, except sourcesContent
+    kept as JSON literals until accessed.
+    compact has same meaning as in create_from_json, lines are collected in SegmentArrays anyway.
+    '''
+    if isinstance(fileobj.read(0), bytes):
+        fileobj = io.TextIOWrapper(fileobj, encoding='utf-8')
+    reader = _ChunkReader(fileobj, chunksize)
+    lines = SegmentArrays()
+    jsondata = reader.sourcemap(lines, use_numpy)
+    if jsondata.get('mappings') is not lines:
+        # index map or sourcemap without mappings
+        return create_from_json(jsondata, compact=compact)
+    jsondata['mappings'] = ''
+    self = create_from_json(jsondata, compact=True)
+    self.lines = lines if compact else list(lines)
     return self
 
 
-def cascade_sourcemaps(mapunder, mapover):
+BINARY_MAGIC = b'SMAPBIN1'
+# magic, number of lines, segments, sources and names
+_binary_header = struct.Struct('<8s4i')
+
+
+class StringTable:
+    '''Read-only sequence of strings of binary sourcemap, every string is decoded from UTF-8 buffer on access'''
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('string index out of range')
+        return str(self.data[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def copy(self):
+        return list(self)
+
+
+def create_from_binary(data):
+    '''
+    Create sourcemap from buffer (bytes, mmap) with binary format written by SourceMap.dump_binary.
+    Format, all numbers are little-endian int32:
+    - header: magic, number of lines, segments, sources and names
+    - index of first segment of every line
+    - segment records of 5 fields: column, source, sourceline, sourcecolumn, name, -1 for absent field
+    - offsets of strings, one more than strings
+    - UTF-8 strings: file, sourceRoot, sources, names
+    - only when sourcemap has sourcesContent: number of its entries, offsets of their JSON literals
+      (one more than entries) and UTF-8 JSON literals, null for absent content
+    Lines are SegmentArrays of views over the buffer, so lookups don't copy anything.
+    sourcesContent entries are decoded from the buffer on access.
+    '''
+    view = memoryview(data)
+    if len(view) < _binary_header.size:
+        raise SourceMapParsingException('Binary sourcemap is truncated')
+    magic, nlines, nsegments, nsources, nnames = _binary_header.unpack_from(view)
+    if magic != BINARY_MAGIC:
+        raise SourceMapParsingException('Bad binary sourcemap')
+    nstrings = 2 + nsources + nnames
+    start = _binary_header.size
+    end = start + 4 * (nlines + 5 * nsegments + nstrings + 1)
+    if len(view) < end:
+        raise SourceMapParsingException('Binary sourcemap is truncated')
+    if sys.byteorder == 'little':
+        ints = view[start:end].cast('i')
+    else:
+        ints = array('i')
+        ints.frombytes(view[start:end])
+        ints.byteswap()
+        ints = memoryview(ints)
+    offsets = ints[:nlines]
+    records = ints[nlines:nlines + 5 * nsegments]
+    stroffsets = ints[nlines + 5 * nsegments:]
+    if len(view) < end + stroffsets[-1]:
+        raise SourceMapParsingException('Binary sourcemap is truncated')
+    strings = StringTable(view[end:end + stroffsets[-1]], stroffsets)
+
+    self = SourceMap()
+    self.file = strings[0]
+    self.sourceRoot = strings[1]
+    self.sources = StringTable(strings.data, stroffsets[2:3 + nsources])
+    self.names = StringTable(strings.data, stroffsets[2 + nsources:])
+    self.lines = SegmentArrays.view(offsets, *[records[field::5] for field in range(5)])
+
+    start = end + stroffsets[-1]
+    if len(view) > start:
+        # content table follows strings unaligned, its offsets are copied
+        if len(view) < start + 4:
+            raise SourceMapParsingException('Binary sourcemap is truncated')
+        ncontents = struct.unpack_from('<i', view, start)[0]
+        end = start + 4 * (ncontents + 2)
+        if ncontents < 0 or len(view) < end:
+            raise SourceMapParsingException('Binary sourcemap is truncated')
+        contentoffsets = array('i')
+        contentoffsets.frombytes(view[start + 4:end])
+        if sys.byteorder != 'little':
+            contentoffsets.byteswap()
+        if len(view) < end + contentoffsets[-1]:
+            raise SourceMapParsingException('Binary sourcemap is truncated')
+        data = view[end:end + contentoffsets[-1]]
+        self.sourcesContent = SourcesContent(
+            None if b - a == 4 and data[a:b] == b'null' else (data, a, b)
+            for a, b in zip(contentoffsets, contentoffsets[1:])
+        )
+    return self
+
+
+def load_binary(filename):
+    '''Open binary sourcemap with mmap, so memory pages of the file are shared by all processes using it'''
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return create_from_binary(data)
+
+
+def _cascade_numpy(under, over, sourcemap, add_name, undernames, overnames):
+    np = numpy
+
+    def field(arr):
+        return np.asarray(arr).astype(np.int64)
+
+    def offsets(lines):
+        return np.asarray(lines.offsets).astype(np.int64)
+
+    ucolumns = field(under.columns)
+    usegline = np.searchsorted(offsets(under), np.arange(ucolumns.size), side='right') - 1
+    # segments of mapunder are ordered by (line, column), so they can be searched at once
+    ukeys = (usegline << 32) | ucolumns
+
+    osources = field(over.sources)
+    olines = field(over.sourcelines)
+    ocolumns = field(over.sourcecolumns)
+    onames = field(over.names)
+    idx = np.flatnonzero((osources >= 0) & (olines >= 0) & (ocolumns >= 0))
+    k = np.searchsorted(ukeys, (olines[idx] << 32) | ocolumns[idx], side='right') - 1
+    found = k >= 0
+    found[found] = usegline[k[found]] == olines[idx[found]]
+    usources = field(under.sources)
+    found[found] = usources[k[found]] >= 0
+    stats_count('cascade segments', int(idx.size))
+    stats_count('cascade misses', int(idx.size - np.count_nonzero(found)))
+    idx, k = idx[found], k[found]
+
+    n = osources.size
+    rsources = np.full(n, -1, dtype=np.int64)
+    rsourcelines = np.full(n, -1, dtype=np.int64)
+    rsourcecolumns = np.full(n, -1, dtype=np.int64)
+    rnames = np.full(n, -1, dtype=np.int64)
+    rsources[idx] = np.array(sourcemap, dtype=np.int64)[usources[k]]
+    rsourcelines[idx] = field(under.sourcelines)[k]
+    rsourcecolumns[idx] = field(under.sourcecolumns)[k]
+
+    # name codes: mapunder names first, then mapover names; result names are added in order of first use
+    unames = field(under.names)[k]
+    code = np.where(unames >= 0, unames, np.where(onames[idx] >= 0, len(undernames) + onames[idx], -1))
+    used, first = np.unique(code, return_index=True)
+    first, used = first[used >= 0], used[used >= 0]
+    codemap = np.full(len(undernames) + len(overnames), -1, dtype=np.int64)
+    for c in used[np.argsort(first)].tolist():
+        codemap[c] = add_name(undernames[c] if c < len(undernames) else overnames[c - len(undernames)])
+    named = code >= 0
+    rnames[idx[named]] = codemap[code[named]]
+
+    result = SegmentArrays()
+    result.offsets.extend(over.offsets)
+    result.columns.extend(over.columns)
+    for arr, values in ((result.sources, rsources), (result.sourcelines, rsourcelines),
+                        (result.sourcecolumns, rsourcecolumns), (result.names, rnames)):
+        arr.frombytes(values.astype(np.intc).tobytes())
+    return result
+
+
+@_timed('cascade')
+def cascade_sourcemaps(mapunder, mapover, use_numpy=None):
     '''
     sourceRoot for each SourceMap instance required to be normalized absolute file path.
     source for each SourceMap can be relative to sourceRoot or absolute file path.
+
+    Segments of mapover line are resolved against mapunder in one sweep while their targets
+    advance along the same line of mapunder, repeated targets are resolved once.
+    Names of mapunder take precedence, names of mapover are kept where mapunder has none.
+    Segments whose target is not found in mapunder become unmapped, they are counted as cascade misses in stats.
+    When both maps are SegmentArrays and NumPy is installed, all segments are resolved at once,
+    use_numpy can force either way.
     '''
     result = SourceMap()
 
-    # TODO: names!
-
     result.file = mapover.file
     result.sourceRoot = ''
-    result.sources = [safe_join(mapunder.sourceRoot, v) for v in mapunder.sources]
+    result.sources = list(mapunder.source_paths())
+    result.sourcesContent = mapunder.sourcesContent
 
-    sourceindex = {v: i for i, v in enumerate(result.sources)}
+    sourceindex = {}
+    for i, v in enumerate(result.sources):
+        sourceindex.setdefault(v, i)
+    sourcemap = [sourceindex[v] for v in result.sources]
 
-    for line in mapover.lines:
-        resultline = []
-        for seg in line:
-            if len(seg) == 2:
-                resultline.append(seg)
+    nameindex = {}
+
+    def add_name(name):
+        if name not in nameindex:
+            nameindex[name] = len(result.names)
+            result.names.append(name)
+        return nameindex[name]
+
+    undernames = [None] * len(mapunder.names)
+    overnames = [None] * len(mapover.names)
+
+    under = mapunder.lines
+    undercompact = isinstance(under, SegmentArrays)
+    if undercompact:
+        usources, usourcelines, usourcecolumns, unames = \
+            under.sources, under.sourcelines, under.sourcecolumns, under.names
+    over = mapover.lines
+    overcompact = isinstance(over, SegmentArrays)
+
+    if use_numpy is None:
+        use_numpy = numpy is not None and undercompact and overcompact and \
+            len(over.columns) >= numpy_threshold // 4
+    if use_numpy:
+        result.lines = _cascade_numpy(under, over, sourcemap, add_name, mapunder.names, mapover.names)
+        return result
+
+    rfields = [], [], [], [], []
+    rcolumns, rsources, rsourcelines, rsourcecolumns, rnames = rfields
+    roffsets = []
+    memo = {}  # (line, column) in mapunder: (source, line, column, name) in result or None
+    # sweep state: current line of mapunder, its columns and segment range, sweep start and previous target column
+    curline = None
+    undercolumns, seglist, lo, hi = None, None, 0, 0
+    start = prevcol = 0
+    for i in range(len(over)):
+        roffsets.append(len(rcolumns))
+        if overcompact:
+            a, b = over.line_range(i)
+            segs = zip(over.columns[a:b], over.sources[a:b], over.sourcelines[a:b],
+                       over.sourcecolumns[a:b], over.names[a:b])
+        else:
+            segs = [(seg + (-1, -1, -1, -1))[:5] if len(seg) < 5 else seg for seg in over[i]]
+        for column, source, line, col, name in segs:
+            target = None
+            if source >= 0:
+                target = memo.get((line, col), False)
+                if target is False:
+                    target = None
+                    if line != curline:
+                        curline = line
+                        try:
+                            undercolumns, lo, hi = mapunder._line_index(line)
+                            seglist = None if undercompact else under[line]
+                        except IndexError:
+                            undercolumns, lo = None, 0
+                        start = lo
+                    elif col < prevcol:
+                        start = lo  # targets went backwards, sweep from line start again
+                    prevcol = col
+                    if undercolumns is not None:
+                        k = bisect_right(undercolumns, col, start, hi) - 1
+                        if k >= lo:
+                            start = k
+                            if undercompact:
+                                seg = (None, usources[k], usourcelines[k], usourcecolumns[k], unames[k])
+                            else:
+                                seg = seglist[k - lo]
+                            if len(seg) > 4 and seg[4] >= 0:
+                                if undernames[seg[4]] is None:
+                                    undernames[seg[4]] = add_name(mapunder.names[seg[4]])
+                                target = (sourcemap[seg[1]], seg[2], seg[3], undernames[seg[4]])
+                            elif len(seg) > 1 and seg[1] >= 0:
+                                target = (sourcemap[seg[1]], seg[2], seg[3], -1)
+                    memo[line, col] = target
+            rcolumns.append(column)
+            if target is None:
+                rsources.append(-1)
+                rsourcelines.append(-1)
+                rsourcecolumns.append(-1)
+                rnames.append(-1)
+                continue
+            rsources.append(target[0])
+            rsourcelines.append(target[1])
+            rsourcecolumns.append(target[2])
+            if target[3] < 0 and name >= 0:
+                if overnames[name] is None:
+                    overnames[name] = add_name(mapover.names[name])
+                rnames.append(overnames[name])
             else:
-                try:
-                    lk = mapunder.lookup(seg[2], seg[3], useSourceRoot=True)
-                    resultline.append((
-                        seg[0],  # starting column
-                        sourceindex[lk['source']],  # source file
-                        lk['line'],  # line in source
-                        lk['column'],  # column in source
-                    ))
-                except SegmentNotFoundException:
-                    resultline.append((seg[0],))
-                except IndexError:
-                    resultline.append((seg[0],))
-        result.lines.append(resultline)
+                rnames.append(target[3])
+
+    if _stats is not None:
+        if overcompact:
+            sources = over.sources if isinstance(over.sources, array) else list(over.sources)
+            mapped = len(sources) - sources.count(-1)
+        else:
+            mapped = sum(len(seg) > 1 and seg[1] >= 0 for segs in over for seg in segs)
+        _stats.add('cascade segments', mapped)
+        _stats.add('cascade misses', mapped - (len(rsources) - rsources.count(-1)))
+        _stats.add('cascade memo hits', mapped - len(memo))
+
+    if overcompact:
+        result.lines = SegmentArrays.from_fields(roffsets, *rfields)
+    else:
+        result.lines = list(SegmentArrays.from_fields(roffsets, *rfields))
     return result
 
 
-def concat_sourcemaps(*items):
+def cascade_chain(*maps):
+    '''
+    Compose sourcemaps of several build stages, ordered from the first stage (closest to sources) to the last one.
+    Composition goes from the last stage down, so every intermediate result is only as large as
+    the final map and holds only positions which are actually referenced.
+    Requirements for sourceRoot and sources are same as for cascade_sourcemaps.
+    '''
+    if len(maps) < 2:
+        raise ValueError('At least two sourcemaps are required for cascade')
+    result = maps[-1]
+    for mapunder in reversed(maps[:-1]):
+        result = cascade_sourcemaps(mapunder, result)
+    return result
+
+
+@_timed('concat')
+def concat_sourcemaps(*items, compact=False):
     '''You can pass as item:
     - SourceMap instance
     - list of lines of lexeme lengths (identity map): (sourceFileName, [[lexemelen, lexemelen, ...], [lexemelen, lexemelen, ...], ...])
@@ -246,64 +1976,466 @@ def concat_sourcemaps(*items):
     source for each SourceMap can be relative to sourceRoot or absolute file path.
 
     sourceFileName for each list of lines required to be normalized absolute file path.
+
+    With compact=True resulting map stores lines as SegmentArrays.
     '''
     result = SourceMap()
+    if compact:
+        result.lines = SegmentArrays()
     smap = {}
+    nmap = {}
+    contents = SourcesContent()
     for item in items:
         if isinstance(item, int):
             for i in range(item):
                 result.lines.append([])
         elif isinstance(item, SourceMap):
             local_smap = {}
-            for i, source in enumerate(item.sources):
-                source = safe_join(item.sourceRoot, source)
+            for i, source in enumerate(item.source_paths()):
                 if source not in smap:
                     smap[source] = len(result.sources)
                     result.sources.append(source)
+                    contents.append(None)
+                contents.fill_from(smap[source], item.sourcesContent, i)
                 local_smap[i] = smap[source]
+            local_nmap = {}
+            for i, name in enumerate(item.names):
+                if name not in nmap:
+                    nmap[name] = len(result.names)
+                    result.names.append(name)
+                local_nmap[i] = nmap[name]
+            if compact and isinstance(item.lines, SegmentArrays):
+                result.lines.extend(item.lines, local_smap, local_nmap)
+                continue
             for line in item.lines:
                 rline = []
                 for seg in line:
                     if len(seg) == 1:
                         rline.append(seg)
-                    else:
-                        # TODO: names
+                    elif len(seg) == 4:
                         rline.append((seg[0], local_smap[seg[1]], seg[2], seg[3]))
+                    else:
+                        rline.append((seg[0], local_smap[seg[1]], seg[2], seg[3], local_nmap[seg[4]]))
                 result.lines.append(rline)
         else:
             sname = item[0]
             if sname not in smap:
                 smap[sname] = len(result.sources)
                 result.sources.append(sname)
+                contents.append(None)
             sidx = smap[sname]
-            for line in item[1]:
+            for lineno, line in enumerate(item[1]):
                 rline = []
                 column = 0
-                for i, lexlen in enumerate(line):
-                    rline.append((column, sidx, i, column))
+                for lexlen in line:
+                    rline.append((column, sidx, lineno, column))
                     column += lexlen
                 result.lines.append(rline)
+    if contents.has_content():
+        result.sourcesContent = contents
     return result
 
 
+_segment_re = re.compile('[^,;]+')
+
+
+def _mappings_sums(mappings, state=(0, 0, 0, 0), states=None):
+    '''
+    Sums of source, sourceline, sourcecolumn and name deltas of whole mappings string added to state.
+    If states array is given, the sums at every line separator are appended to it.
+    '''
+    sums = [0]
+    sums.extend(state)
+    field = 0
+    value = shift = 0
+    try:
+        for d in mappings.encode('ascii', 'replace').translate(_vlq_translation):
+            if d < 0x20:
+                value += d << shift
+                sums[field] += -(value >> 1) if value & 1 else value >> 1
+                field += 1
+                value = shift = 0
+            elif d < 64:
+                value += (d & 0x1F) << shift
+                shift += 5
+            elif d == 66:
+                raise SourceMapParsingException('Invalid character in mappings')
+            else:
+                field = 0
+                if d == 65 and states is not None:
+                    states.extend(sums[1:])
+    except IndexError:
+        raise SourceMapParsingException('Invalid segment in mappings')
+    return sums[1:]
+
+
+def _drop_mappings_line(mappings, line):
+    start = 0
+    for _ in range(line):
+        start = mappings.find(';', start) + 1
+        if start == 0:
+            return mappings  # no such line
+    end = mappings.find(';', start)
+    if end == -1:
+        return mappings[:max(start - 1, 0)]
+    if start == end:
+        return mappings[:start] + mappings[end + 1:]
+    # segments of removed line affect deltas of following lines
+    lines = decode_mappings(mappings)
+    lines.pop(line)
+    return encode_mappings(lines)
+
+
+def _is_offset(indexes):
+    return all(v == indexes[0] + i for i, v in enumerate(indexes))
+
+
+class ConcatWriter:
+    '''
+    Streaming version of concat_sourcemaps. Mappings of every added item are written to fileobj at once,
+    only sources and names tables are kept until finish() writes the rest of sourcemap JSON.
+    sourcesContent literals are spooled to temporary file as their sources are added, equal ones once,
+    and copied from it by finish().
+
+    Mappings of added sourcemaps are not decoded into segments: the first segments referring to source
+    and name are rebased on the output and the rest is copied as is. An item is decoded and encoded again
+    only when its sources or names can't be shifted by a constant offset (some of them were added before).
+
+    Requirements for sources are same as for concat_sourcemaps.
+    '''
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sources = []
+        self.names = []
+        self._contents = []  # for every source: None or (start, size) of JSON literal in spool file
+        self._spool = None
+        self._digests = {}  # sha1 of JSON literal: (start, size)
+        self._sourceindex = {}
+        self._nameindex = {}
+        self._state = [0, 0, 0, 0]  # last source, sourceline, sourcecolumn, name written
+        self._lines = 0
+        fileobj.write('{"version": 3, "mappings": "')
+
+    def _index(self, table, index, values):
+        result = []
+        for v in values:
+            if v not in index:
+                index[v] = len(table)
+                table.append(v)
+            result.append(index[v])
+        return result
+
+    def _rebase(self, mappings, sourceoffset, nameoffset, hasnames, sums):
+        state = self._state
+        sourcefound = False
+        namefound = not hasnames
+        pieces = []
+        last = 0
+        for m in _segment_re.finditer(mappings):
+            fields = parse_vlq64(m.group())
+            changed = False
+            if not sourcefound and len(fields) >= 4:
+                fields[1] += sourceoffset - state[0]
+                fields[2] -= state[1]
+                fields[3] -= state[2]
+                sourcefound = changed = True
+            if not namefound and len(fields) == 5:
+                fields[4] += nameoffset - state[3]
+                namefound = changed = True
+            if changed:
+                pieces.append(mappings[last:m.start()])
+                pieces.append(dump_vlq64(fields))
+                last = m.end()
+            if sourcefound and namefound:
+                break
+        if not pieces:
+            return mappings
+        pieces.append(mappings[last:])
+        if sourcefound:
+            state[0] = sums[0] + sourceoffset
+            state[1] = sums[1]
+            state[2] = sums[2]
+        if hasnames and namefound:
+            state[3] = sums[3] + nameoffset
+        return ''.join(pieces)
+
+    def _write(self, mappings, nlines):
+        if nlines == 0 and not mappings:
+            return
+        mlines = mappings.count(';') + 1
+        if nlines is None:
+            nlines = mlines
+        elif mlines > nlines:
+            raise ValueError('Sourcemap contains more lines than code')
+        with stats_phase('write'):
+            if self._lines:
+                self.fileobj.write(';')
+            self.fileobj.write(mappings)
+            self.fileobj.write(';' * (nlines - mlines))
+        self._lines += nlines
+
+    def _add_content(self, k, contents, i):
+        '''Spool entry i of sourcesContent sequence as content of source k, unless source k has content already'''
+        if self._contents[k] is not None or contents is None or i >= len(contents):
+            return
+        literal = contents.raw(i) if isinstance(contents, SourcesContent) else json.dumps(contents[i])
+        if literal == 'null':
+            return
+        data = literal.encode('utf-8', 'surrogatepass')
+        digest = hashlib.sha1(data).digest()
+        span = self._digests.get(digest)
+        if span is None:
+            if self._spool is None:
+                self._spool = tempfile.TemporaryFile()
+            span = self._digests[digest] = (self._spool.tell(), len(data))
+            self._spool.write(data)
+        self._contents[k] = span
+
+    def add_lines(self, count):
+        '''Add not mapped lines'''
+        if count:
+            self._write('', count)
+
+    def add_mappings(self, mappings, sources, names=(), nlines=None, dropline=None, sums=None, contents=None):
+        '''
+        Add raw mappings string with its sources, names and sourcesContent.
+        nlines is count of code lines, mappings are padded with empty lines up to it.
+        dropline is index of line to remove from mappings (as sourceMappingURL marker line removed from code).
+        Returns sums of source, sourceline, sourcecolumn and name deltas of mappings, they are computed
+        by scanning whole mappings string, so can be kept and passed as sums when the same mappings are added again.
+        '''
+        if dropline is not None:
+            mappings = _drop_mappings_line(mappings, dropline)
+        if sums is None:
+            sums = _mappings_sums(mappings)
+        localsources = self._index(self.sources, self._sourceindex, sources)
+        for i, k in enumerate(localsources):
+            if k == len(self._contents):  # source added now
+                self._contents.append(None)
+            self._add_content(k, contents, i)
+        localnames = self._index(self.names, self._nameindex, names)
+        if _is_offset(localsources) and _is_offset(localnames):
+            sourceoffset = localsources[0] if localsources else 0
+            nameoffset = localnames[0] if localnames else 0
+            rebased = self._rebase(mappings, sourceoffset, nameoffset, bool(localnames), sums)
+            stats_count('concat rebased')
+        else:
+            stats_count('concat reencoded')
+            lines = SegmentArrays()
+            lines.extend(decode_mappings(mappings), localsources, localnames)
+            remapped = encode_mappings(lines)
+            rebased = self._rebase(remapped, 0, 0, bool(localnames), _mappings_sums(remapped))
+        self._write(rebased, nlines)
+        return sums
+
+    def add_sourcemap(self, smap, nlines=None, dropline=None):
+        if isinstance(smap.lines, LazyLines):
+            mappings = smap.lines.mappings
+        else:
+            mappings = encode_mappings(smap.lines)
+        sources = smap.source_paths()
+        self.add_mappings(mappings, sources, smap.names, nlines, dropline, contents=smap.sourcesContent)
+
+    def add_identity(self, source, lexlines):
+        lines = SegmentArrays()
+        for lineno, line in enumerate(lexlines):
+            lines.newline()
+            column = 0
+            for lexlen in line:
+                lines.add(column, 0, lineno, column)
+                column += lexlen
+        self.add_mappings(encode_mappings(lines), [source], (), len(lexlines))
+
+    def add(self, item):
+        '''Add item of any kind accepted by concat_sourcemaps'''
+        if isinstance(item, int):
+            self.add_lines(item)
+        elif isinstance(item, SourceMap):
+            self.add_sourcemap(item)
+        else:
+            self.add_identity(*item)
+
+    def finish(self, file='', sourceRoot='', sources=None):
+        '''
+        Write the rest of sourcemap JSON, sources can be replaced (e.g. by relative ones).
+        '''
+        self.fileobj.write('", ')
+        tail = json.dumps({
+            'file': file,
+            'sourceRoot': sourceRoot,
+            'sources': self.sources if sources is None else sources,
+            'names': self.names,
+        })[1:]
+        if self._spool is None:
+            self.fileobj.write(tail)
+            return
+        spool = self._spool
+        self.fileobj.write(tail[:-1] + ', "sourcesContent": [')
+        for k, span in enumerate(self._contents):
+            if k:
+                self.fileobj.write(', ')
+            if span is None:
+                self.fileobj.write('null')
+            else:
+                spool.seek(span[0])
+                self.fileobj.write(spool.read(span[1]).decode('utf-8', 'surrogatepass'))
+        self.fileobj.write(']}')
+        spool.close()
+        self._spool = None
+
+
+# sourcemap url marker is searched in this number of the last lines of file
+MARKER_LINES = 5
+
+
+def parse_marker(line):
+    '''Return sourcemap url of sourceMappingURL marker line or None'''
+    line = line.lstrip()
+    if not (line.startswith('//@') or line.startswith('//#') or line.startswith('/*#')):
+        return None
+    line = line[3:].lstrip()
+    if not line.startswith('sourceMappingURL='):
+        return None
+    _, url = line.split('=', 1)
+    url, _ = (url.strip() + ' ').split(' ', 1)
+    return url.strip()
+
+
+def _read_tail(raw, nlines, blocksize):
+    '''
+    Return (offset, lines) with the last nlines lines (bytes with line breaks) of seekable binary file.
+    Tail is read by blocks doubling in size until it holds enough lines, long lines (inline sourcemaps) included.
+    '''
+    end = raw.seek(0, io.SEEK_END)
+    start = end
+    while True:
+        start = max(0, start - blocksize)
+        raw.seek(start)
+        lines = raw.read(end - start).splitlines(keepends=True)
+        if start == 0 or len(lines) > nlines:
+            break
+        blocksize *= 2
+    if start > 0:
+        start += len(lines.pop(0))  # line cut by start of block
+    skipped = lines[:-nlines]
+    return start + sum(len(line) for line in skipped), lines[len(skipped):]
+
+
+def _count_line_breaks(raw, end, blocksize=1 << 20):
+    '''Count lines ending before end offset of binary file, line breaks are same as in text mode'''
+    raw.seek(0)
+    count = pos = 0
+    prevcr = False
+    while pos < end:
+        block = raw.read(min(blocksize, end - pos))
+        if not block:
+            break
+        count += block.count(b'\n') + block.count(b'\r') - block.count(b'\r\n')
+        if prevcr and block.startswith(b'\n'):
+            count -= 1
+        prevcr = block.endswith(b'\r')
+        pos += len(block)
+    return count
+
+
+def _binary_file(file):
+    '''Binary file under text file object, None if it can't seek'''
+    raw = getattr(file, 'buffer', file)
+    try:
+        if not raw.seekable():
+            return None
+    except (AttributeError, ValueError):
+        return None
+    if raw is not file:
+        file.flush()
+    return raw
+
+
+def find_marker(file, blocksize=1 << 16):
+    '''
+    Find sourceMappingURL marker reading only the tail of seekable file (text or binary),
+    return (url, start, end), where start and end are byte offsets of marker line (end includes line break).
+    Raises IndexError if there is no marker in the last MARKER_LINES lines.
+    '''
+    raw = _binary_file(file)
+    if raw is None:
+        raise ValueError('File is not seekable')
+    offset, lines = _read_tail(raw, MARKER_LINES, blocksize)
+    for line in lines:
+        url = parse_marker(line.decode('utf-8', 'replace'))
+        if url is not None:
+            return url, offset, offset + len(line)
+        offset += len(line)
+    raise IndexError('Couldn\'t find sourceMappingURL in file')
+
+
+def set_marker(file, url, blocksize=1 << 16):
+    '''
+    Set sourceMappingURL marker of file opened for reading and writing (text or binary) in place:
+    old marker line is removed and the new one is written at the end of file (without line break).
+    Only the tail of file after old marker is rewritten.
+    '''
+    raw = _binary_file(file)
+    if raw is None:
+        raise ValueError('File is not seekable')
+    try:
+        _, start, end = find_marker(raw, blocksize)
+        raw.seek(end)
+        rest = raw.read()
+    except IndexError:
+        start, rest = raw.seek(0, io.SEEK_END), b''
+    raw.seek(start)
+    raw.write(rest)
+    raw.write('//# sourceMappingURL={}'.format(url).encode('utf-8'))
+    raw.truncate()
+    raw.flush()
+
+
+def decode_data_url(url):
+    '''Return text of data: URL (inline sourcemap), base64 or percent-encoded'''
+    if not url.startswith('data:'):
+        raise ValueError('Not a data URL')
+    header, sep, data = url[5:].partition(',')
+    if not sep:
+        raise SourceMapParsingException('Invalid data URL')
+    params = header.split(';')
+    charset = 'utf-8'
+    for param in params[1:]:
+        if param.startswith('charset='):
+            charset = param[8:]
+    try:
+        if params[-1] == 'base64':
+            data = base64.b64decode(data, validate=True)
+        else:
+            data = unquote_to_bytes(data)
+        return data.decode(charset)
+    except (binascii.Error, LookupError, UnicodeDecodeError) as e:
+        raise SourceMapParsingException('Invalid data URL: {}'.format(e))
+
+
 def discover_sourcemap(file, return_line_number=False):
-    # TODO: split method to find_marker, parse_marker, set_marker
+    '''
+    Return sourcemap url from marker in the last lines of file (or list of its lines),
+    with return_line_number=True returns (url, number of marker line).
+    Seekable files are not read whole, only counting line number reads up to the marker.
+    Raises IndexError if there is no marker.
+    '''
     if isinstance(file, list):
         lines = file
     else:
+        raw = _binary_file(file)
+        if raw is not None:
+            url, start, _ = find_marker(raw)
+            if return_line_number:
+                return (url, _count_line_breaks(raw, start))
+            return url
         lines = file.readlines()
-    lnum = len(lines) - 5 - 1
-    for line in lines[-5:]:
+    lnum = max(len(lines) - MARKER_LINES, 0) - 1
+    for line in lines[-MARKER_LINES:]:
         lnum += 1
-        line = line.lstrip()
-        if not (line.startswith('//@') or line.startswith('//#') or line.startswith('/*#')):
-            continue
-        line = line[3:].lstrip()
-        if not line.startswith('sourceMappingURL='):
+        url = parse_marker(line)
+        if url is None:
             continue
-        _, url = line.split('=', 1)
-        url, _ = (url.strip() + ' ').split(' ', 1)
-        url = url.strip()
         if return_line_number:
             return (url, lnum)
         return url
@@ -1,12 +1,22 @@
 import argparse
-from sourcemap_lib import discover_sourcemap, create_from_json, concat_sourcemaps, cascade_sourcemaps, safe_join
-from os.path import join, dirname, normpath, isabs, relpath, basename, abspath, split as path_split
-from sys import exit, stderr
-
-
-def print_near(fname, line, col):
-    with open(fname) as f:
-        lines = f.readlines()
+import asyncio
+import hashlib
+import io
+import json
+import re
+from collections import OrderedDict
+from os import stat, makedirs, listdir, remove
+from sourcemap_lib import discover_sourcemap, set_marker, decode_data_url, create_from_json, create_from_file, concat_sourcemaps, cascade_sourcemaps, safe_join, ConcatWriter, dump_index_map, \
+    load_binary, BINARY_MAGIC, encode_mappings, Stats, set_stats, stats_phase, stats_count
+from os.path import join, dirname, normpath, isabs, relpath, basename, abspath, isdir, split as path_split
+from sys import exit, stderr, stdin, stdout
+
+
+def print_near(fname, line, col, lines=None):
+    '''Print code around position, lines of source are read from fname if they are not given'''
+    if lines is None:
+        with open(fname) as f:
+            lines = f.readlines()
     width = 80
     from_, to_ = col - width // 2, col + width // 2
     if from_ < 0:
@@ -35,56 +45,223 @@ def full_path_split(path):
     return result
 
 
+def sourcemap_location(filename, file):
+    '''
+    Return (sourcemap path, inline) for compiled file, only the tail of file is read.
+    Path of inline sourcemap (data: URL) is the compiled file itself.
+    '''
+    url = discover_sourcemap(file)
+    if url.startswith('data:'):
+        return filename, True
+    return filepath_relative_to_file(filename, url), False
+
+
+def load_sourcemap(mapname, inline=False):
+    '''Load JSON sourcemap lazily or open binary one, with inline=True sourcemap is decoded from data: URL in mapname file'''
+    if inline:
+        with open(mapname, 'rb') as f:
+            with stats_phase('read'):
+                url = discover_sourcemap(f)
+        return create_from_json(decode_data_url(url), lazy=True)
+    with open(mapname, 'rb') as mapfile:
+        if mapfile.read(len(BINARY_MAGIC)) == BINARY_MAGIC:
+            return load_binary(mapname)
+    with open(mapname, 'r') as mapfile:
+        with stats_phase('read'):
+            text = mapfile.read()
+    return create_from_json(text, lazy=True)
+
+
 def lookup(args):
+    if args.bulk is not None:
+        return lookup_bulk(args)
+    if args.file is None or args.line is None or args.column is None:
+        print('File, line and column are required without --bulk', file=stderr)
+        exit(2)
     if args.mapfile:
-        mapname = args.mapfile
+        mapname, inline = args.mapfile.name, False
     else:
-        mapname = filepath_relative_to_file(args.file.name, discover_sourcemap(args.file))
-    with open(mapname, 'r') as mapfile:
-        mp = create_from_json(mapfile.read())
+        mapname, inline = sourcemap_location(args.file.name, args.file)
+    mp = load_sourcemap(mapname, inline)
     try:
-        lk = mp.lookup(args.line, args.column)
+        with stats_phase('lookup'):
+            lk = mp.lookup(args.line, args.column)
     except IndexError:
         exit(1)  # if position not found
     sourcename = filepath_relative_to_file(mapname, lk['source'])
     if not args.showcode:
         print('{} {} {}'.format(sourcename, lk['line'], lk['column']))
     else:
-        print_near(sourcename, lk['line'], lk['column'])
-
-
-def lex(code_lines, lexername):
-    try:
-        from pygments.lexers import get_lexer_by_name
-        from pygments import lex
-    except ImportError:
-        print('For lexer support please install extras: pip install sourcemap-tool[lexer]', file=stderr)
-        exit(1)
-
-    # TODO: join lexemes with trailing space, remove comment lexemes
-    lexer = get_lexer_by_name(lexername)
-    tokens = lex(''.join(code_lines), lexer)
+        # code embedded in sourcemap is preferred to file
+        content = mp.source_content(lk['source'])
+        print_near(sourcename, lk['line'], lk['column'],
+                   None if content is None else io.StringIO(content, newline=None).readlines())
+
+
+def lookup_bulk(args):
+    '''
+    Lookup positions read from args.bulk, each line is "line column" for file given in arguments
+    or "file line column". Results are printed as JSON lines in order of positions, same as in serve.
+    Every sourcemap is loaded once and every source file is read once.
+    '''
+    results = []
+    groups = OrderedDict()  # (mapname, inline): [(result index, line, column), ...]
+    mapnames = {}  # compiled file name: (mapname, inline) or error
+    for text in args.bulk:
+        parts = text.split()
+        if not parts:
+            continue
+        result = {}
+        results.append(result)
+        try:
+            if len(parts) == 3:
+                filename = parts[0]
+            elif len(parts) == 2 and (args.mapfile or args.file):
+                filename = args.file.name if args.file else None
+            else:
+                raise ValueError('Expected "[file] line column", got "{}"'.format(text.strip()))
+            line, column = int(parts[-2]), int(parts[-1])
+            if line < 0 or column < 0:
+                raise ValueError('Line and column must be non-negative')
+            if args.mapfile:
+                mapname = (args.mapfile.name, False)
+            else:
+                if filename not in mapnames:
+                    try:
+                        with open(filename, 'rb') as f:
+                            mapnames[filename] = sourcemap_location(filename, f)
+                    except IndexError:
+                        mapnames[filename] = ValueError('Sourcemap url not found in {}'.format(filename))
+                    except OSError as e:
+                        mapnames[filename] = e
+                mapname = mapnames[filename]
+                if isinstance(mapname, Exception):
+                    raise mapname
+        except (ValueError, OSError) as e:
+            result['error'] = str(e)
+            continue
+        groups.setdefault(mapname, []).append((len(results) - 1, line, column))
+
+    sources = {}  # source file name: lines
+    for (mapname, inline), positions in groups.items():
+        try:
+            smap = load_sourcemap(mapname, inline)
+        except (ValueError, OSError) as e:
+            for i, _, _ in positions:
+                results[i]['error'] = str(e)
+            continue
+        with stats_phase('lookup'):
+            lks = smap.lookup_many([(line, column) for _, line, column in positions])
+        for (i, _, _), lk in zip(positions, lks):
+            result = results[i]
+            if lk is None:
+                result['error'] = 'Position not found'
+                continue
+            result['source'] = filepath_relative_to_file(mapname, lk['source'])
+            result['line'] = lk['line']
+            result['column'] = lk['column']
+            if 'name' in lk:
+                result['name'] = smap.names[lk['name']]
+            if args.showcode:
+                if result['source'] not in sources:
+                    content = smap.source_content(lk['source'])
+                    if content is not None:
+                        sources[result['source']] = content.splitlines()
+                    else:
+                        try:
+                            with open(result['source']) as f:
+                                sources[result['source']] = f.read().splitlines()
+                        except OSError:
+                            sources[result['source']] = None
+                lines = sources[result['source']]
+                if lines is not None:
+                    result['code'] = lines[max(0, lk['line'] - 3):lk['line'] + 3]
+
+    for result in results:
+        print(json.dumps(result))
+
+
+# simple tokenizer for C-like languages: whitespace, comments, strings, identifiers, numbers, operators, other chars
+# operators are split as pygments javascript lexer does, regex and template literals are single lexemes
+_regex_lexer = re.compile(r'''
+    \s+
+    | //[^\n]* | /\*.*?\*/
+    | "(?:[^"\\\n]|\\.)*"? | '(?:[^'\\\n]|\\.)*'? | `(?:[^`\\]|\\.)*`?
+    | [^\W\d]\w* | \d[\w.]*
+    | \+\+ | -- | \?\?=? | => | \.\.\. | (?:<<|>>>?|==?|!=?|\*\*|\|\||&&|[-<>+*%&|^/])=?
+    | .
+''', re.S | re.X)
+
+
+def lexeme_lines(texts, merge_whitespace=False):
+    '''
+    Split token texts into lines of lexeme lengths.
+    With merge_whitespace whitespace is joined to previous lexeme of line (or to the next one at line start).
+    '''
     result = []
     line = []
-    for _, text in tokens:
+    pending = 0  # whitespace at line start
+    for text in texts:
         parts = text.split('\n')
-        if len(parts) > 1: # multiline token
-            first = True
-            for part in parts:
-                if not first:
-                    result.append(line)
-                    line = []
-                first = False
-                if len(part) > 0:
-                    line.append(len(part))
-        else:
-            if len(text) > 0:
-                line.append(len(text))
+        for i, part in enumerate(parts):
+            if i:  # multiline token
+                result.append(line)
+                line = []
+                pending = 0
+            if not part:
+                continue
+            if merge_whitespace and part.isspace():
+                if line:
+                    line[-1] += len(part)
+                else:
+                    pending += len(part)
+            else:
+                line.append(pending + len(part))
+                pending = 0
     if line:
         result.append(line)
     return result
 
 
+def lex(code_lines, lexername, merge_whitespace=False, cachedir=None):
+    '''
+    Lines of lexeme lengths of code, lexername is pygments lexer name or "regex" for builtin tokenizer.
+    Results are kept in cachedir by hash of lexer name, options and code.
+    '''
+    code = ''.join(code_lines)
+    if cachedir is not None:
+        key = hashlib.sha1('{}\0{}\0'.format(lexername, merge_whitespace).encode('utf-8'))
+        key.update(code.encode('utf-8'))
+        cachepath = join(cachedir, key.hexdigest() + '.json')
+        try:
+            with open(cachepath, 'r') as f:
+                result = json.load(f)
+            stats_count('lexer cache hits')
+            return result
+        except (OSError, ValueError):
+            stats_count('lexer cache misses')
+
+    with stats_phase('lex'):
+        if lexername == 'regex':
+            texts = _regex_lexer.findall(code)
+        else:
+            try:
+                from pygments.lexers import get_lexer_by_name
+                from pygments import lex
+            except ImportError:
+                print('For lexer support please install extras: pip install sourcemap-tool[lexer]', file=stderr)
+                exit(1)
+            lexer = get_lexer_by_name(lexername)
+            texts = (text for _, text in lex(code, lexer))
+        result = lexeme_lines(texts, merge_whitespace)
+
+    if cachedir is not None:
+        makedirs(cachedir, exist_ok=True)
+        with open(cachepath, 'w') as f:
+            json.dump(result, f)
+    return result
+
+
 def absolute_sourceRoot(mappath, sourceRoot):
     return safe_join(
         abspath(dirname(mappath)),
@@ -92,107 +269,477 @@ def absolute_sourceRoot(mappath, sourceRoot):
     )
 
 
+def relative_paths(paths, start):
+    '''relpath of every path to start directory, directory of paths is resolved once for all its files'''
+    start = abspath(start)
+    dirs = {}
+    result = []
+    for path in paths:
+        head, tail = path_split(path)
+        if not tail:
+            result.append(relpath(path, start))
+            continue
+        if head not in dirs:
+            dirs[head] = relpath(head or '.', start)
+        result.append(tail if dirs[head] == '.' else join(dirs[head], tail))
+    return result
+
+
 def root_paths(paths):
+    '''
+    Split paths into common root directory and paths relative to it.
+    Every path is split once and the root is shortened while paths are scanned, so it takes linear time.
+    '''
+    splits = [full_path_split(v) for v in paths]
     similarity = None
-    for v in paths:
-        vsp = full_path_split(v)[:-1]  # exclude file name
+    for vsp in splits:
+        vsp = vsp[:-1]  # exclude file name
         if similarity is None:
             similarity = vsp
-        else:
-            for i, (a, b) in enumerate(zip(vsp, similarity)):
-                if a != b:
-                    similarity = similarity[:i]
-                    break
-    if similarity is None:
-        newroot, newpaths = '', paths
+            continue
+        common = min(len(vsp), len(similarity))
+        for i in range(common):
+            if vsp[i] != similarity[i]:
+                common = i
+                break
+        del similarity[common:]
+    if not similarity:
+        return '', list(paths)
+    simlen = len(similarity)
+    return join(*similarity), [join(*vsp[simlen:]) for vsp in splits]
+
+
+def open_concat_file(fconfig):
+    '''Read file for concatenation, return its code lines without sourcemap url marker, sourcemap path and marker line'''
+    with stats_phase('read'):
+        code_lines = fconfig['file'].readlines()
+    try:
+        mapurl, markerline = discover_sourcemap(code_lines, return_line_number=True)
+        code_lines.pop(markerline) # remove sourcemap url marker from code
+    except IndexError:
+        mapurl, markerline = None, None # sourcemap not detected
+
+    mappath = None
+    if 'map' in fconfig:
+        mappath = fconfig['map'].name  # direct setting sourcemap path
     else:
-        simlen = len(similarity)
-        newpaths = [join(*( full_path_split(v)[simlen:] )) for v in paths]
-        newroot = join(*similarity)
-    return newroot, newpaths
+        if mapurl is not None:
+            if mapurl.startswith('data:'):
+                raise ValueError('Inline sourcemap of {} is not supported, assign sourcemap file with --map'.format(fconfig['file'].name))
+            mappath = filepath_relative_to_file(fconfig['file'].name, mapurl)
+    return code_lines, mappath, markerline
+
+
+def write_mapurl(args):
+    args.outfile.write('//# sourceMappingURL={}'.format(
+        relpath( args.outmap.name, start=dirname(args.outfile.name) )
+    ))
+
+
+def concat_item(filename, code_lines, mappath, markerline, lexer, merge_whitespace=False, lexercache=None):
+    '''
+    Load sourcemap or lex code of file for concat_sourcemaps,
+    it runs in worker processes with --jobs so gets only picklable arguments
+    '''
+    if mappath is not None:
+        # sourcemap file exists
+        with open(mappath, 'r') as f:
+            smap = create_from_file(f, compact=True)
+        if markerline is not None:
+            try:
+                smap.lines.pop(markerline)  # deleting same line from sourcemap too
+            except IndexError:
+                pass
+        if len(smap.lines) > len(code_lines):
+            raise ValueError('Sourcemap for file {} contains more lines than original code'.format(filename))
+        while len(smap.lines) < len(code_lines):
+            smap.lines.append([])
+
+        smap.sourceRoot = absolute_sourceRoot(mappath, smap.sourceRoot)
+        return smap
+    elif lexer is not None:
+        return ( abspath(filename), lex(code_lines, lexer, merge_whitespace, lexercache) )
+    return len(code_lines)
 
 
 def concat(args):
+    if args.index_map:
+        return concat_index(args)
+    if args.manifest is not None:
+        return concat_incremental(args)
+    if args.stream:
+        return concat_stream(args)
     result_code = []
-    smaplist = []
+    jobs = []
     for fconfig in args.file:
-        code_lines = fconfig['file'].readlines()
-        try:
-            mapurl, markerline = discover_sourcemap(code_lines, return_line_number=True)
-            code_lines.pop(markerline) # remove sourcemap url marker from code
-        except IndexError:
-            mapurl, markerline = None, None # sourcemap not detected
-
-        mappath = None
-        if 'map' in fconfig:
-            mappath = fconfig['map']  # direct setting sourcemap path
-        else:
-            if mapurl is not None:
-                mappath = filepath_relative_to_file(fconfig['file'].name, mapurl)
+        code_lines, mappath, markerline = open_concat_file(fconfig)
+        result_code.extend(code_lines)
+        jobs.append((fconfig['file'].name, code_lines, mappath, markerline, fconfig.get('lexer', None),
+                     args.merge_whitespace, args.lexer_cache))
+    if args.jobs > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            # results come back in order of files
+            smaplist = list(executor.map(concat_item, *zip(*jobs), chunksize=max(1, len(jobs) // (args.jobs * 4))))
+    else:
+        smaplist = [concat_item(*job) for job in jobs]
+    mergedmap = concat_sourcemaps(*smaplist, compact=True)
+    if args.optimize:
+        mergedmap.optimize()
+
+    mergedmap.sourceRoot, mergedmap.sources = root_paths(relative_paths(mergedmap.sources, dirname(args.outmap.name)))
+
+    mergedmap.dump_to(args.outmap)
+    with stats_phase('write'):
+        args.outfile.writelines(result_code)
+    write_mapurl(args)
 
+
+def concat_stream(args):
+    '''
+    Write code and mappings of every file as soon as it is read,
+    sourcemaps are not decoded but rebased (see ConcatWriter)
+    '''
+    writer = ConcatWriter(args.outmap)
+    for fconfig in args.file:
+        code_lines, mappath, markerline = open_concat_file(fconfig)
         if mappath is not None:
-            # sourcemap file exists
             with open(mappath, 'r') as f:
-                smap = create_from_json(f.read())
-            if markerline is not None:
-                try:
-                    smap.lines.pop(markerline)  # deleting same line from sourcemap too
-                except IndexError:
-                    pass
+                smap = create_from_json(f.read(), lazy=True)
+            smap.sourceRoot = absolute_sourceRoot(mappath, smap.sourceRoot)
+            try:
+                writer.add_sourcemap(smap, len(code_lines), dropline=markerline)
+            except ValueError:
+                raise ValueError('Sourcemap for file {} contains more lines than original code'.format(fconfig['file'].name))
+        elif fconfig.get('lexer', None) is not None:
+            writer.add_identity(abspath(fconfig['file'].name), lex(code_lines, fconfig['lexer'], args.merge_whitespace, args.lexer_cache))
+        else:
+            writer.add_lines(len(code_lines))
+        with stats_phase('write'):
+            args.outfile.writelines(code_lines)
+
+    sourceRoot, sources = root_paths(relative_paths(writer.sources, dirname(args.outmap.name)))
+    writer.finish(sourceRoot=sourceRoot, sources=sources)
+    write_mapurl(args)
+
+
+def concat_index(args):
+    '''
+    Write index map with a section for every file having sourcemap or lexer,
+    mappings of sourcemaps are copied to sections without decoding
+    '''
+    outdir = abspath(dirname(args.outmap.name))
+    sections = []
+    line = 0
+    for fconfig in args.file:
+        code_lines, mappath, markerline = open_concat_file(fconfig)
+        if mappath is not None:
+            with open(mappath, 'r') as f:
+                smap = create_from_json(f.read(), lazy=True)
+            if markerline is not None and markerline < len(smap.lines):
+                smap.lines.pop(markerline)  # deleting same line from sourcemap too
             if len(smap.lines) > len(code_lines):
                 raise ValueError('Sourcemap for file {} contains more lines than original code'.format(fconfig['file'].name))
-            while len(smap.lines) < len(code_lines):
-                smap.lines.append([])
-
-            smap.sourceRoot = absolute_sourceRoot(mappath, smap.sourceRoot)
-
+            smap.sourceRoot = relpath(absolute_sourceRoot(mappath, smap.sourceRoot), start=outdir)
+            sections.append((line, 0, smap))
         elif fconfig.get('lexer', None) is not None:
-            smap = ( abspath(fconfig['file'].name), lex(code_lines, fconfig['lexer']) )
+            smap = concat_sourcemaps(( abspath(fconfig['file'].name), lex(code_lines, fconfig['lexer'], args.merge_whitespace, args.lexer_cache) ))
+            smap.sources = relative_paths(smap.sources, outdir)
+            smap.sourceRoot = ''
+            sections.append((line, 0, smap))
+        line += len(code_lines)
+        with stats_phase('write'):
+            args.outfile.writelines(code_lines)
+
+    args.outmap.write(dump_index_map(sections))
+    write_mapurl(args)
+
+
+def concat_incremental(args):
+    '''
+    Streaming concat (see concat_stream) keeping encoded mappings of every file as fragment.
+    Fragments are sourcemaps in directory next to manifest (manifest name with .fragments),
+    manifest keeps signature, line count and fragment name of every file.
+    On the next run sourcemaps are loaded and files are lexed only if they were changed,
+    mappings and sourcesContent of other files are copied from their fragments without decoding.
+    The output sourcemap is written again as a whole.
+    '''
+    fragments = abspath(args.manifest + '.fragments')
+    previous = {}
+    try:
+        with open(args.manifest, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == 4:
+            previous = {tuple(item['key']): item for item in manifest['items']}
+    except (OSError, ValueError, AttributeError, KeyError, TypeError):
+        pass  # no manifest or it's broken, so everything is processed
+
+    writer = ConcatWriter(args.outmap)
+    items = []
+    changed = len(previous) != len(args.file)
+    for fconfig in args.file:
+        code_lines, mappath, markerline = open_concat_file(fconfig)
+        lexer = fconfig.get('lexer', None)
+        key = [abspath(fconfig['file'].name), abspath(mappath) if mappath is not None else None, lexer]
+        signature = hashlib.sha1(''.join(code_lines).encode('utf-8'))
+        signature.update('{} {}'.format(markerline, args.merge_whitespace).encode('ascii'))
+        if mappath is not None:
+            mapstat = stat(mappath)
+            signature.update('{} {}'.format(mapstat.st_mtime_ns, mapstat.st_size).encode('ascii'))
+        item = previous.get(tuple(key))
+        smap = None
+        if item is not None and item['signature'] == signature.hexdigest() and 'fragment' in item:
+            try:
+                with open(join(fragments, item['fragment']), 'r') as f:
+                    smap = create_from_json(f.read(), lazy=True)
+            except (OSError, ValueError):
+                item = None  # fragment is lost or broken, file is processed again
+        if item is None or item['signature'] != signature.hexdigest():
+            changed = True
+            item = {'key': key, 'signature': signature.hexdigest(), 'nlines': len(code_lines)}
+            if mappath is not None:
+                with open(mappath, 'r') as f:
+                    smap = create_from_json(f.read(), lazy=True)
+                sourceRoot = absolute_sourceRoot(mappath, smap.sourceRoot)
+                smap.sources = [safe_join(sourceRoot, source) for source in smap.sources]
+                item['dropline'] = markerline
+            elif lexer is not None:
+                identity = concat_sourcemaps(( abspath(fconfig['file'].name), lex(code_lines, lexer, args.merge_whitespace, args.lexer_cache) ), compact=True)
+                smap = create_from_json({'version': 3, 'sources': [], 'names': [], 'mappings': encode_mappings(identity.lines)}, lazy=True)
+                smap.sources = identity.sources
+            if smap is not None:
+                # fragment is written with sources relative to it, mappings and sourcesContent are copied raw
+                item['fragment'] = hashlib.sha1(json.dumps([key, item['signature']]).encode('utf-8')).hexdigest() + '.map'
+                makedirs(fragments, exist_ok=True)
+                smap.file, smap.sourceRoot = '', ''
+                sources = smap.sources
+                smap.sources = relative_paths(sources, fragments)
+                with open(join(fragments, item['fragment']), 'w') as f:
+                    smap.dump_to(f)
+                smap.sources = sources
+        elif smap is not None:
+            smap.sources = [safe_join(fragments, source) for source in smap.sources]
+        if smap is not None:
+            try:
+                item['sums'] = writer.add_mappings(smap.lines.mappings, smap.sources, smap.names, item['nlines'],
+                                                   item.get('dropline'), item.get('sums'), smap.sourcesContent)
+            except ValueError:
+                raise ValueError('Sourcemap for file {} contains more lines than original code'.format(fconfig['file'].name))
         else:
-            smap = len(code_lines)
-        result_code.extend(code_lines)
-        smaplist.append(smap)
-    mergedmap = concat_sourcemaps(*smaplist)
-
-    mergedmap.sourceRoot, mergedmap.sources = root_paths([
-        relpath( source, start=abspath(dirname(args.outmap.name)) ) \
-        for source in mergedmap.sources
-    ])
-
-    args.outmap.write(mergedmap.dump())
-    args.outfile.writelines(result_code)
-    args.outfile.write('//# sourceMappingURL={}'.format(
-        relpath( args.outmap.name, start=dirname(args.outfile.name) )
-    ))
+            writer.add_lines(item['nlines'])
+        items.append(item)
+        with stats_phase('write'):
+            args.outfile.writelines(code_lines)
+
+    sourceRoot, sources = root_paths(relative_paths(writer.sources, dirname(args.outmap.name)))
+    writer.finish(sourceRoot=sourceRoot, sources=sources)
+    write_mapurl(args)
+    if changed:
+        with open(args.manifest, 'w') as f:
+            json.dump({'version': 4, 'items': items}, f)
+        # fragments of changed and removed files are not used anymore
+        used = {item['fragment'] for item in items if 'fragment' in item}
+        for name in listdir(fragments) if isdir(fragments) else ():
+            if name not in used:
+                remove(join(fragments, name))
 
 
 def cascade(args):
-    mapunder = create_from_json(args.mapunder.read())
-    mapover = create_from_json(args.mapover.read())
-
-    mapunder.sourceRoot = absolute_sourceRoot(args.mapunder.name, mapunder.sourceRoot)
-    mapover.sourceRoot = absolute_sourceRoot(args.mapover.name, mapover.sourceRoot)
-
-    resultmap = cascade_sourcemaps(mapunder, mapover)
-    resultmap.sourceRoot, resultmap.sources = root_paths([
-        relpath( source, start=abspath(dirname(args.outmap.name)) ) \
-        for source in resultmap.sources
-    ])
-    args.outmap.write(resultmap.dump())
+    def load(mapfile):
+        smap = create_from_file(mapfile, compact=True)
+        smap.sourceRoot = absolute_sourceRoot(mapfile.name, smap.sourceRoot)
+        return smap
+
+    if len(args.maps) < 2:
+        print('At least two sourcemaps are required for cascade', file=stderr)
+        exit(2)
+    # compose from the last stage down, keeping only current underlying map and partial result
+    resultmap = load(args.maps[-1])
+    for mapfile in reversed(args.maps[:-1]):
+        resultmap = cascade_sourcemaps(load(mapfile), resultmap)
+    if args.optimize:
+        resultmap.optimize()
+
+    resultmap.sourceRoot, resultmap.sources = root_paths(relative_paths(resultmap.sources, dirname(args.outmap.name)))
+    resultmap.dump_to(args.outmap)
 
     if args.fixmapurl is not None:
-        rcode_lines = args.fixmapurl.readlines()
+        # old url is removed and the new one is appended, only the tail of file is rewritten
+        set_marker(args.fixmapurl, relpath( args.outmap.name, start=dirname(args.fixmapurl.name) ))
+
+
+def tobinary(args):
+    smap = create_from_file(args.map, compact=True)
+    smap.dump_binary(args.outmap)
+
+
+def tojson(args):
+    load_binary(args.map.name).dump_to(args.outmap)
+
+
+class LRUCache:
+    '''Keeps at most size recently used items'''
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def __setitem__(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+
+class LookupServer:
+    '''
+    Answers JSON lookup requests, loaded sourcemaps and sourcemap paths of compiled files are kept in LRU caches.
+    Files are loaded again when their modification time changes.
+    '''
+    def __init__(self, cachesize):
+        self.maps = LRUCache(cachesize)  # mapname: (mtime, sourcemap)
+        self.mapnames = LRUCache(cachesize)  # compiled file name: (mtime, (mapname, inline))
+        self.loading = {}  # mapname: future of sourcemap being loaded
+
+    def find_mapname(self, filename):
+        mtime = stat(filename).st_mtime_ns
+        entry = self.mapnames.get(filename)
+        if entry is None or entry[0] != mtime:
+            with open(filename, 'rb') as f:
+                entry = (mtime, sourcemap_location(filename, f))
+            self.mapnames[filename] = entry
+        return entry[1]
+
+    async def get_map(self, mapname, inline=False):
+        mtime = stat(mapname).st_mtime_ns
+        key = (mapname, inline)
+        entry = self.maps.get(key)
+        if entry is not None and entry[0] == mtime:
+            stats_count('map cache hits')
+            return entry[1]
+        stats_count('map cache misses')
+        # concurrent requests for the same sourcemap wait for single loading
+        future = self.loading.get(key)
+        if future is None:
+            future = self.loading[key] = asyncio.get_running_loop().run_in_executor(None, load_sourcemap, mapname, inline)
+        try:
+            smap = await future
+        finally:
+            if self.loading.get(key) is future:
+                del self.loading[key]
+        self.maps[key] = (mtime, smap)
+        return smap
+
+    async def handle(self, line):
+        '''Answer one request line, return response line'''
+        response = {}
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('Request must be object')
+            if 'id' in request:
+                response['id'] = request['id']
+            line, column = request['line'], request['column']
+            # bool is int too, but true/false are not positions
+            if type(line) is not int or type(column) is not int or line < 0 or column < 0:
+                raise ValueError('Line and column must be non-negative integers')
+            if 'map' in request:
+                if not isinstance(request['map'], str):
+                    raise ValueError('Field map must be string')
+                mapname, inline = request['map'], False
+            else:
+                if not isinstance(request['file'], str):
+                    raise ValueError('Field file must be string')
+                try:
+                    mapname, inline = self.find_mapname(request['file'])
+                except IndexError:
+                    raise ValueError('Sourcemap url not found in {}'.format(request['file']))
+            smap = await self.get_map(mapname, inline)
+            try:
+                with stats_phase('lookup'):
+                    lk = smap.lookup(line, column)
+            except IndexError:
+                response['error'] = 'Position not found'
+            else:
+                response['source'] = filepath_relative_to_file(mapname, lk['source'])
+                response['line'] = lk['line']
+                response['column'] = lk['column']
+                if 'name' in lk:
+                    response['name'] = smap.names[lk['name']]
+        except KeyError as e:
+            response['error'] = 'Missing request field {}'.format(e)
+        except (ValueError, OSError) as e:
+            response['error'] = str(e)
+        return json.dumps(response)
+
+
+async def serve_stream(server, lines, write):
+    '''Answer requests concurrently, responses are written in order of requests'''
+    pending = asyncio.Queue()
+
+    async def respond():
+        while True:
+            task = await pending.get()
+            if task is None:
+                return
+            try:
+                response = await task
+            except Exception as e:
+                # unexpected failure of one request must not stop answering the others
+                response = json.dumps({'error': 'Internal error: {}'.format(e)})
+            await write(response)
+
+    writer = asyncio.ensure_future(respond())
+    async for line in lines:
+        if line.strip():
+            await pending.put(asyncio.ensure_future(server.handle(line)))
+    await pending.put(None)
+    await writer
+
+
+async def stdin_lines():
+    loop = asyncio.get_running_loop()
+    while True:
+        line = await loop.run_in_executor(None, stdin.readline)
+        if not line:
+            return
+        yield line
+
+
+async def stdout_write(response):
+    stdout.write(response + '\n')
+    stdout.flush()
+
+
+async def serve_socket(server, path):
+    async def client(reader, writer):
+        async def write(response):
+            writer.write(response.encode('utf-8') + b'\n')
+            await writer.drain()
         try:
-            _, markerline = discover_sourcemap(rcode_lines, return_line_number=True)
-            rcode_lines.pop(markerline)
-            args.fixmapurl.seek(0)  # rewrite file to remove old url
-            args.fixmapurl.truncate()
-            args.fixmapurl.writelines(rcode_lines)
-        except IndexError:
-            pass
-        args.fixmapurl.write('//# sourceMappingURL={}'.format(
-            relpath( args.outmap.name, start=dirname(args.fixmapurl.name) )
-        ))
+            await serve_stream(server, reader, write)
+        finally:
+            writer.close()
+
+    unix_server = await asyncio.start_unix_server(client, path)
+    async with unix_server:
+        await unix_server.serve_forever()
+
+
+def serve(args):
+    server = LookupServer(args.cache)
+    try:
+        if args.socket is not None:
+            asyncio.run(serve_socket(server, args.socket))
+        else:
+            asyncio.run(serve_stream(server, stdin_lines(), stdout_write))
+    except KeyboardInterrupt:
+        pass
 
 
 def non_negative_int(line):
@@ -202,6 +749,13 @@ def non_negative_int(line):
     return val
 
 
+def positive_int(value):
+    val = int(value)
+    if val < 1:
+        raise argparse.ArgumentTypeError('{} is not positive'.format(val))
+    return val
+
+
 class FileConcatList(argparse.Action):
     def __call__(self, parser, namespace, value, option_string):
         lst = getattr(namespace, 'file')
@@ -220,36 +774,75 @@ class FileConcatList(argparse.Action):
 
 def create_parser():
     parser = argparse.ArgumentParser(description='Swiss knife for sourcemaps')
+    parser.add_argument('--stats', action='store_true', help='Print timings of phases and counters (segments, cache hits, lookup misses) as JSON to stderr, '
+                                                             'work of --jobs processes is not counted')
     subparsers = parser.add_subparsers(dest='tool', title='available tools')
     subparsers.required=True
 
     parser_lookup = subparsers.add_parser('lookup', help='Perform sourcemap lookup', description='For given position in compiled file find position in source')
-    parser_lookup.add_argument('file', type=argparse.FileType('r'), help='Compiled file used for lookup')
-    parser_lookup.add_argument('line', type=non_negative_int, help='Line number (counting from zero)')
-    parser_lookup.add_argument('column', type=non_negative_int, help='Column number, character position in line (counting from zero)')
+    parser_lookup.add_argument('file', type=argparse.FileType('r'), nargs='?', help='Compiled file used for lookup')
+    parser_lookup.add_argument('line', type=non_negative_int, nargs='?', help='Line number (counting from zero)')
+    parser_lookup.add_argument('column', type=non_negative_int, nargs='?', help='Column number, character position in line (counting from zero)')
     # TODO: rename to map
     parser_lookup.add_argument('--mapfile', type=argparse.FileType('r'), help='Directly assign sourcemap file')
-    parser_lookup.add_argument('--showcode', action='store_true', help='Output vicinal code from source file')
+    parser_lookup.add_argument('--showcode', action='store_true', help='Output vicinal code from sourcesContent of sourcemap or from source file')
+    parser_lookup.add_argument('--bulk', type=argparse.FileType('r'), help='Lookup positions listed in file ("-" for stdin) as "line column" or "file line column" lines, print results as JSON lines')
     parser_lookup.set_defaults(func=lookup)
 
     parser_concat = subparsers.add_parser('concat', help='Concatenate sourcemaps and scripts')
     group = parser_concat.add_argument_group('files for concatenation', 'Use multiple series of these arguments starting with --file')
     group.add_argument('--file', type=argparse.FileType('r'), action=FileConcatList, required=True, help='Files for concatenation. Can have or have no sourcemap, can even be any raw code')
     group.add_argument('--map', type=argparse.FileType('r'), action=FileConcatList, help='Directly assign sourcemap')
-    group.add_argument('--lexer', action=FileConcatList, help='Use certain pygments lexer for file without sourcemap')
+    group.add_argument('--lexer', action=FileConcatList, help='Use certain pygments lexer (or "regex" for fast builtin tokenizer of C-like languages, regex and template literals are single lexemes) for file without sourcemap')
     group = parser_concat.add_argument_group('output')
     group.add_argument('--outfile', type=argparse.FileType('w'), required=True, help='Output path for concatenated code')
     group.add_argument('--outmap', type=argparse.FileType('w'), required=True, help='Output path for concatenated sourcemap')
+    group.add_argument('--stream', action='store_true', help='Write code and sourcemap file by file without holding all of them in memory')
+    group.add_argument('--index-map', action='store_true', help='Write index map with a section per file instead of merging mappings')
+    group.add_argument('--optimize', action='store_true', help='Drop redundant segments, unused sources and names (not used with --stream, --index-map and --manifest)')
+    group.add_argument('--manifest', help='Keep encoded mappings of files in this manifest file, on the next run only changed files are processed (implies --stream)')
+    group = parser_concat.add_argument_group('lexers')
+    group.add_argument('--merge-whitespace', action='store_true', help='Join whitespace to neighbouring lexemes, so less segments are created')
+    group.add_argument('--lexer-cache', help='Directory for caching lexer results')
+    group = parser_concat.add_argument_group('processing')
+    group.add_argument('--jobs', type=positive_int, default=1, help='Number of processes parsing sourcemaps and lexing files (not used with --stream, --index-map and --manifest)')
     parser_concat.set_defaults(func=concat)
 
     parser_cascade = subparsers.add_parser('cascade', help='Merge multiple stage sourcemaps')
-    parser_cascade.add_argument('mapunder', type=argparse.FileType('r'), help='Underlying map (previous step)')
-    parser_cascade.add_argument('mapover', type=argparse.FileType('r'), help='Overlying map (next step applied on top of result of previous)')
+    parser_cascade.add_argument('maps', type=argparse.FileType('r'), nargs='+', help='Sourcemaps of build steps, starting from the first one (closest to sources), each next map is applied on top of result of previous')
     parser_cascade.add_argument('outmap', type=argparse.FileType('w'), help='Output path for resulting combined sourcemap')
     parser_cascade.add_argument('--fixmapurl', type=argparse.FileType('r+'), help='Resulting code file for autofixing sourcemap url')
+    parser_cascade.add_argument('--optimize', action='store_true', help='Drop redundant segments, unused sources and names')
     parser_cascade.set_defaults(func=cascade)
+
+    parser_serve = subparsers.add_parser('serve', help='Answer lookup requests until input is closed',
+        description='Read newline-delimited JSON requests {"file": compiled file, "line": ..., "column": ...} '
+                    '("map" can be given instead of "file", "id" is copied to response) '
+                    'and write JSON responses {"source": ..., "line": ..., "column": ..., "name": ...} or {"error": ...} in the same order. '
+                    'Loaded sourcemaps are kept in memory.')
+    parser_serve.add_argument('--socket', help='Listen on unix socket instead of stdin/stdout')
+    parser_serve.add_argument('--cache', type=positive_int, default=64, help='Number of sourcemaps kept in memory')
+    parser_serve.set_defaults(func=serve)
+
+    parser_tobinary = subparsers.add_parser('tobinary', help='Convert sourcemap to binary format', description='Binary sourcemap is memory mapped on lookup instead of parsing')
+    parser_tobinary.add_argument('map', type=argparse.FileType('r'), help='Sourcemap in JSON format')
+    parser_tobinary.add_argument('outmap', type=argparse.FileType('wb'), help='Output path for binary sourcemap')
+    parser_tobinary.set_defaults(func=tobinary)
+
+    parser_tojson = subparsers.add_parser('tojson', help='Convert binary sourcemap to JSON format')
+    parser_tojson.add_argument('map', type=argparse.FileType('rb'), help='Binary sourcemap')
+    parser_tojson.add_argument('outmap', type=argparse.FileType('w'), help='Output path for sourcemap in JSON format')
+    parser_tojson.set_defaults(func=tojson)
     return parser
 
 if __name__ == '__main__':
     args = create_parser().parse_args()
-    args.func(args)
+    stats = None
+    if args.stats:
+        stats = Stats()
+        set_stats(stats)
+    try:
+        args.func(args)
+    finally:
+        if stats is not None:
+            print(json.dumps(stats.report()), file=stderr)
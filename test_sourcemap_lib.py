@@ -0,0 +1,102 @@
+'''
+Tests of sourcemap_lib APIs not covered by NumPy equivalence tests.
+Run with python -m unittest or pytest.
+'''
+import io
+import json
+import random
+import unittest
+
+from sourcemap_lib import (GREATEST_LOWER_BOUND, LEAST_UPPER_BOUND, ConcatWriter, SourceMapParsingException,
+                           concat_sourcemaps, create_from_binary, create_from_json)
+from sourcemap_bench import generate_map
+
+
+class LookupManyTest(unittest.TestCase):
+    def loaded(self, text):
+        return [create_from_json(text), create_from_json(text, compact=True), create_from_json(text, lazy=True)]
+
+    def test_lines_outside_map(self):
+        text = '{"version": 3, "sources": ["a.js"], "names": [], "mappings": "AAAA"}'
+        for smap in self.loaded(text):
+            self.assertEqual(smap.lookup_many([(5, 0)]), [None])
+            self.assertEqual(smap.lookup_many([(-3, 0), (5, 0), (0, 2), (1, 0)]),
+                             [None, None, {'source': 'a.js', 'line': 0, 'column': 0}, None])
+            self.assertEqual(smap.lookup_many([]), [])
+            with self.assertRaises(ValueError):
+                smap.lookup_many([(0, -1)])
+
+    def test_same_as_lookup(self):
+        text = generate_map(lines=300, segments=20).dump()
+        r = random.Random(0)
+        positions = [(r.randrange(-20, 320), r.randrange(150)) for _ in range(3000)]
+        for smap in self.loaded(text):
+            for bias in (GREATEST_LOWER_BOUND, LEAST_UPPER_BOUND):
+                expected = []
+                for line, column in positions:
+                    try:
+                        expected.append(smap.lookup(line, column, bias=bias))
+                    except IndexError:
+                        expected.append(None)
+                self.assertEqual(smap.lookup_many(positions, bias=bias), expected)
+
+    def test_shared_results(self):
+        text = '{"version": 3, "sources": ["a.js"], "names": ["x"], "mappings": "AAAAA,EAAE"}'
+        for smap in self.loaded(text):
+            first, second, other = smap.lookup_many([(0, 0), (0, 1), (0, 2)])
+            self.assertIs(first, second)
+            self.assertEqual(other, {'source': 'a.js', 'line': 0, 'column': 2})
+
+
+class ConcatWriterTest(unittest.TestCase):
+    def test_sources_content(self):
+        texts = [
+            json.dumps({'version': 3, 'sources': ['a.js', 'shared.js'], 'names': [], 'mappings': 'AAAA;ACAA',
+                        'sourcesContent': ['a \u00e9 "q"\n', None]}),
+            json.dumps({'version': 3, 'sources': ['b.js'], 'names': [], 'mappings': 'AAAA'}),
+            json.dumps({'version': 3, 'sources': ['shared.js', 'c.js'], 'names': [], 'mappings': 'AAAA;ACAA',
+                        'sourcesContent': ['shared', 'a \u00e9 "q"\n']}),
+        ]
+        buf = io.StringIO()
+        writer = ConcatWriter(buf)
+        for text in texts:
+            writer.add_sourcemap(create_from_json(text, lazy=True))
+        writer.finish()
+        result = json.loads(buf.getvalue())
+        self.assertEqual(result['sources'], ['a.js', 'shared.js', 'b.js', 'c.js'])
+        self.assertEqual(result['sourcesContent'], ['a \u00e9 "q"\n', 'shared', None, 'a \u00e9 "q"\n'])
+        expected = concat_sourcemaps(*[create_from_json(text) for text in texts])
+        self.assertEqual(json.loads(expected.dump())['sourcesContent'], result['sourcesContent'])
+
+    def test_without_content(self):
+        buf = io.StringIO()
+        writer = ConcatWriter(buf)
+        writer.add_sourcemap(create_from_json('{"version": 3, "sources": ["a.js"], "names": [], "mappings": "AAAA"}'))
+        writer.finish()
+        self.assertNotIn('sourcesContent', json.loads(buf.getvalue()))
+
+
+class BinaryTest(unittest.TestCase):
+    def test_sources_content(self):
+        text = json.dumps({'version': 3, 'sources': ['a.js', 'b.js', 'c.js'], 'names': ['x'],
+                           'mappings': 'AAAAA;ACAA;ACAA', 'sourcesContent': ['a \u00e9 \U0001f600\n', None, '"q"']})
+        for smap in (create_from_json(text), create_from_json(text, compact=True), create_from_json(text, lazy=True)):
+            buf = io.BytesIO()
+            smap.dump_binary(buf)
+            loaded = create_from_binary(buf.getvalue())
+            self.assertEqual(list(loaded.sourcesContent), ['a \u00e9 \U0001f600\n', None, '"q"'])
+            self.assertEqual(json.loads(loaded.dump()), json.loads(smap.dump()))
+            with self.assertRaises(SourceMapParsingException):
+                create_from_binary(buf.getvalue()[:-3])
+
+    def test_without_content(self):
+        text = '{"version": 3, "sources": ["a.js"], "names": [], "mappings": "AAAA"}'
+        buf = io.BytesIO()
+        create_from_json(text).dump_binary(buf)
+        loaded = create_from_binary(buf.getvalue())
+        self.assertIsNone(loaded.sourcesContent)
+        self.assertNotIn('sourcesContent', json.loads(loaded.dump()))
+
+
+if __name__ == '__main__':
+    unittest.main()
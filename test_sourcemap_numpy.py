@@ -0,0 +1,101 @@
+'''
+NumPy and pure Python implementations of mappings decoding, encoding and cascade must give equal results.
+Run with python -m unittest or pytest.
+'''
+import unittest
+
+import sourcemap_lib
+from sourcemap_lib import (SegmentArrays, SourceMapParsingException, cascade_sourcemaps, create_from_json,
+                           decode_mappings, encode_mappings)
+from sourcemap_bench import generate_chain, generate_map
+
+
+MAPPINGS = [
+    '',
+    ';',
+    ';;',
+    'A',
+    'AAAA',
+    'AAAAA',
+    'AAAA,CAAC;;EAAE,GAAG,IAAIA',
+    ';;AACA;',
+    'gBAAgB,kBAAmB;A,C,D;;;AAAA',
+    'gkxHGh3oE+pjG,KACFw+B;CAAA',
+    'AAAA;' * 50 + 'CAAC',
+    ','.join(['CACA'] * 100) + ';' + ','.join(['CAAAC'] * 50),
+]
+
+INVALID = [
+    'A,',
+    ',A',
+    'AA',
+    'AAA',
+    'AAAAAA',
+    'AgA',
+    'Ag',
+    'AAAA;g',
+    'AA!A',
+    'AAAA,,AAAA',
+    'AAAA;,AAAA',
+    'AAAA,;AAAA',
+    'AAAA,',
+]
+
+
+@unittest.skipIf(sourcemap_lib.numpy is None, 'NumPy is not installed')
+class NumpyEquivalenceTest(unittest.TestCase):
+    def assertLinesEqual(self, a, b):
+        self.assertEqual(list(a.offsets), list(b.offsets))
+        for field in ('columns', 'sources', 'sourcelines', 'sourcecolumns', 'names'):
+            self.assertEqual(list(getattr(a, field)), list(getattr(b, field)), field)
+
+    def test_decode(self):
+        for mappings in MAPPINGS:
+            with self.subTest(mappings=mappings):
+                expected = decode_mappings(mappings, use_numpy=False)
+                self.assertLinesEqual(decode_mappings(mappings, use_numpy=True), expected)
+                # small batches carry decoder state over many pieces
+                for batchsize in (1, 3, 7):
+                    self.assertLinesEqual(decode_mappings(mappings, use_numpy=True, batchsize=batchsize), expected)
+                    self.assertLinesEqual(decode_mappings(mappings, use_numpy=False, batchsize=batchsize), expected)
+
+    def test_decode_invalid(self):
+        for mappings in INVALID:
+            for use_numpy in (False, True):
+                for batchsize in (1, 2, 3, 1 << 16):
+                    with self.subTest(mappings=mappings, use_numpy=use_numpy, batchsize=batchsize):
+                        with self.assertRaises(SourceMapParsingException):
+                            decode_mappings(mappings, use_numpy=use_numpy, batchsize=batchsize)
+
+    def test_encode(self):
+        for mappings in MAPPINGS:
+            with self.subTest(mappings=mappings):
+                lines = decode_mappings(mappings, use_numpy=False)
+                self.assertEqual(encode_mappings(lines, use_numpy=False), mappings)
+                self.assertEqual(encode_mappings(lines, use_numpy=True), mappings)
+                for batchsize in (1, 3):
+                    self.assertEqual(encode_mappings(lines, use_numpy=True, batchsize=batchsize), mappings)
+
+    def test_generated(self):
+        smap = generate_map(lines=3000, segments=30)
+        mappings = encode_mappings(smap.lines, use_numpy=False)
+        self.assertEqual(encode_mappings(smap.lines, use_numpy=True), mappings)
+        expected = decode_mappings(mappings, use_numpy=False)
+        for batchsize in (1 << 10, 1 << 16, len(mappings) + 1):
+            lines = decode_mappings(mappings, use_numpy=True, batchsize=batchsize)
+            self.assertLinesEqual(lines, expected)
+            self.assertEqual(encode_mappings(lines, use_numpy=True, batchsize=batchsize >> 2), mappings)
+
+    def test_cascade(self):
+        chain = generate_chain(depth=2, lines=1500, segments=30)
+        under, over = [create_from_json(smap.dump(), compact=True) for smap in chain]
+        expected = cascade_sourcemaps(under, over, use_numpy=False)
+        result = cascade_sourcemaps(under, over, use_numpy=True)
+        self.assertIsInstance(result.lines, SegmentArrays)
+        self.assertEqual(result.sources, expected.sources)
+        self.assertEqual(result.names, expected.names)
+        self.assertLinesEqual(result.lines, SegmentArrays(expected.lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
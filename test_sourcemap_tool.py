@@ -0,0 +1,43 @@
+'''
+Tests of sourcemap_tool helpers.
+Run with python -m unittest or pytest.
+'''
+import unittest
+
+from sourcemap_tool import _regex_lexer, lexeme_lines
+
+try:
+    import pygments
+except ImportError:
+    pygments = None
+
+
+OPERATORS = [
+    'if (a !== b && c >= 3) { a += 1; }\n',
+    'const f = (x, ...rest) => x >>> 2 || y << 1 ?? z;\n',
+    'x **= 2; y ??= 3; a?.b; a >>>= 1; c <<= 2;\n',
+    'obj = {"k": \'v\', n: -1}; i++; j--; !x; ~y;\n',
+    '/* multi\nline */ q = 0x1F + 1.5e3; // comment\n',
+]
+
+
+class RegexLexerTest(unittest.TestCase):
+    def test_operators(self):
+        self.assertEqual(_regex_lexer.findall('a !== b && c >= 3'),
+                         ['a', ' ', '!==', ' ', 'b', ' ', '&&', ' ', 'c', ' ', '>=', ' ', '3'])
+        self.assertEqual(_regex_lexer.findall('f=(...r)=>r>>>=1'),
+                         ['f', '=', '(', '...', 'r', ')', '=>', 'r', '>>>=', '1'])
+
+    @unittest.skipIf(pygments is None, 'Pygments is not installed')
+    def test_same_as_pygments(self):
+        from pygments import lex
+        from pygments.lexers import get_lexer_by_name
+        lexer = get_lexer_by_name('javascript')
+        for code in OPERATORS:
+            with self.subTest(code=code):
+                self.assertEqual(lexeme_lines(_regex_lexer.findall(code)),
+                                 lexeme_lines(text for _, text in lex(code, lexer)))
+
+
+if __name__ == '__main__':
+    unittest.main()